@@ -0,0 +1,171 @@
+import threading
+import collections
+import pygame
+from anki import TrackPieceType
+
+from helpers import load_image
+
+SPRITE_ANGLE_STEP = 15
+"""The angle resolution (in degrees) of pre-rotated vehicle sprites"""
+
+Color = tuple[int, int, int]
+
+_imageLock = threading.Lock()
+_images: dict[str, pygame.Surface] = {}
+
+def _convert(image: pygame.Surface) -> pygame.Surface:
+    # Converts into the pixel format of the surfaces the Ui draws on, so blitting doesn't convert.
+    # Unlike convert_alpha this doesn't need a display mode, which is set after the assets are loaded
+    converted = pygame.Surface(image.get_size(), pygame.SRCALPHA)
+    if image.get_colorkey() is not None:
+        # Palette colour keys match an index rather than a colour,
+        # blitting keeps them the way the Ui draws the image
+        converted.blit(image, (0, 0))
+        return converted
+    return image.convert(converted)
+
+def getImage(name: str) -> pygame.Surface:
+    """
+    Loads an image from the images folder once per process.
+    The returned surface is shared, so it must not be modified.
+    """
+    with _imageLock:
+        if name not in _images:
+            _images[name] = _convert(load_image(name))
+        return _images[name]
+
+
+_TILE_IMAGES: dict[TrackPieceType, str] = {
+    TrackPieceType.STRAIGHT: "straight.png",
+    TrackPieceType.CURVE: "curve.png",
+    TrackPieceType.INTERSECTION: "intersection.png",
+    TrackPieceType.START: "Start.png"
+}
+
+class TileAtlas:
+    """
+    All four rotations of each map tile at each layer alpha.
+
+    Layers further down a cell are drawn more transparent.
+    The first `PRECOMPUTED_LAYERS` layers are built up front,
+    deeper ones when they are first used.
+    """
+    PRECOMPUTED_LAYERS = 3
+
+    def __init__(self) -> None:
+        self._tiles: dict[tuple[TrackPieceType, int, int], pygame.Surface] = {}
+        for layer in range(self.PRECOMPUTED_LAYERS):
+            self._addLayer(layer)
+
+    def _addLayer(self, layer: int):
+        for pieceType, name in _TILE_IMAGES.items():
+            for angle in (0, 90, 180, 270):
+                tile = pygame.transform.rotate(getImage(name), angle)
+                tile.set_alpha(int((1.5**-layer)*255))
+                self._tiles[(pieceType, angle, layer)] = tile
+
+    def get(self, pieceType: TrackPieceType, angle: int, layer: int) -> pygame.Surface:
+        key = (pieceType, angle % 360, layer)
+        if key not in self._tiles:
+            self._addLayer(layer)
+        return self._tiles[key]
+
+_tileAtlas: TileAtlas|None = None
+
+def getTileAtlas() -> TileAtlas:
+    """The process-wide tile atlas"""
+    global _tileAtlas
+    with _imageLock:
+        atlas = _tileAtlas
+    if atlas is None:
+        atlas = TileAtlas()
+        with _imageLock:
+            _tileAtlas = atlas
+    return atlas
+
+
+class VehicleSprites:
+    """
+    Pre-tinted and pre-rotated vehicle sprites.
+
+    Sprites are keyed by vehicle colour and quantized angle.
+    All rotations of a colour are built when the colour is added
+    and evicted once no vehicle uses that colour anymore.
+    """
+    def __init__(self, image: pygame.Surface, angleStep: int = SPRITE_ANGLE_STEP) -> None:
+        self._image = image
+        self._angleStep = angleStep
+        self._sprites: dict[tuple[Color, int], pygame.Surface] = {}
+        self._users: dict[Color, int] = {}
+
+    def quantize(self, angle: float) -> int:
+        return int(round(angle/self._angleStep)*self._angleStep) % 360
+
+    def add(self, color: Color):
+        color = tuple(color)
+        if color in self._users:
+            self._users[color] += 1
+            return
+        self._users[color] = 1
+        tinted = self._image.copy()
+        tinted.fill(color, None, pygame.BLEND_RGB_MULT)
+        for angle in range(0, 360, self._angleStep):
+            self._sprites[(color, angle)] = pygame.transform.rotate(tinted, angle)
+
+    def remove(self, color: Color):
+        color = tuple(color)
+        self._users[color] -= 1
+        if self._users[color] > 0:
+            return
+        del self._users[color]
+        for angle in range(0, 360, self._angleStep):
+            del self._sprites[(color, angle)]
+
+    def get(self, color: Color, angle: float) -> pygame.Surface:
+        color = tuple(color)
+        if color not in self._users:
+            # Colours of vehicles that were never added are kept for good
+            self.add(color)
+        return self._sprites[(color, self.quantize(angle))]
+
+
+class TextCache:
+    """
+    A bounded cache of rendered text.
+
+    Surfaces are keyed by font, text and colours.
+    When more than `maxSize` surfaces are cached,
+    the least recently used ones are evicted.
+    The returned surfaces are shared, so they must not be modified.
+    """
+    def __init__(self, maxSize: int = 1024) -> None:
+        self.maxSize = maxSize
+        self._surfs: collections.OrderedDict[tuple, pygame.Surface] = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._surfs)
+
+    def render(
+            self,
+            font: pygame.font.Font,
+            text: str,
+            color: Color,
+            background: Color|None = None
+        ) -> pygame.Surface:
+        key = (font, text, tuple(color), None if background is None else tuple(background))
+        surf = self._surfs.get(key)
+        if surf is not None:
+            self.hits += 1
+            self._surfs.move_to_end(key)
+            return surf
+        self.misses += 1
+        surf = font.render(text, True, color, background)
+        self._surfs[key] = surf
+        if len(self._surfs) > self.maxSize:
+            self._surfs.popitem(last=False)
+        return surf
+
+    def clear(self):
+        self._surfs.clear()
@@ -0,0 +1,170 @@
+import asyncio
+import bisect
+import threading
+import time
+from array import array
+from typing import Any, Callable, Hashable
+
+import anki
+
+LATENCY_BUCKETS: tuple[float, ...] = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)
+"""The upper bounds (in seconds) of the histogram buckets, slower latencies go into an extra bucket"""
+
+STAGES = ("ack", "telemetry")
+"""
+The measured stages of a command, both counted from its submission:
+until the vehicle acknowledged it and until its telemetry reflected it
+"""
+
+
+def _reportedState(vehicle: anki.Vehicle) -> tuple:
+    # The values every telemetry update of a vehicle reports
+    return (vehicle.road_offset, vehicle.speed)
+
+
+class LatencyHistogram:
+    """Counts latencies in the fixed buckets of `LATENCY_BUCKETS`"""
+    def __init__(self) -> None:
+        self.counts = array("Q", bytes(8*(len(LATENCY_BUCKETS)+1)))
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.timeouts = 0
+        """Commands whose telemetry never reflected them"""
+
+    def add(self, latency: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def merge(self, other: "LatencyHistogram"):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.timeouts += other.timeouts
+
+    def copy(self) -> "LatencyHistogram":
+        histogram = LatencyHistogram()
+        histogram.merge(self)
+        return histogram
+
+    @property
+    def mean(self) -> float:
+        return self.total/self.count if self.count else 0.
+
+    def percentile(self, p: float) -> float:
+        """
+        The upper bound of the bucket holding the p-th percentile (p from 0 to 100).
+        Latencies beyond the last bucket are reported as the maximum.
+        """
+        if self.count == 0:
+            return 0.
+        rank = p/100*self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank and seen > 0:
+                return min(bound, self.max)
+        return self.max
+
+
+class CommandLatency:
+    """
+    Measures how long commands take per vehicle.
+
+    Commands are timed from their submission until the vehicle acknowledged them
+    and until the first telemetry update consistent with them.
+    There is no notification of telemetry updates, so vehicles waiting for one
+    are polled on the event loop every `pollInterval` seconds,
+    for at most `telemetryTimeout` seconds.
+    Histograms are recorded on the event loop and can be read from any thread.
+    """
+    def __init__(
+            self,
+            eventLoop: asyncio.AbstractEventLoop,
+            pollInterval: float = 0.01,
+            telemetryTimeout: float = 5
+        ) -> None:
+        self._eventLoop = eventLoop
+        self.pollInterval = pollInterval
+        self.telemetryTimeout = telemetryTimeout
+        self._lock = threading.Lock()
+        self._histograms: dict[tuple[Any, str, str], LatencyHistogram] = {}
+        self._watched: dict[tuple[anki.Vehicle, Hashable], tuple[str, float, float, tuple, Callable[[anki.Vehicle], bool]]] = {}
+        self._poller: asyncio.Task|None = None
+
+    def _histogram(self, vehicleId: Any, command: str, stage: str) -> LatencyHistogram:
+        key = (vehicleId, command, stage)
+        if key not in self._histograms:
+            self._histograms[key] = LatencyHistogram()
+        return self._histograms[key]
+
+    def acknowledged(
+            self,
+            vehicle: anki.Vehicle,
+            command: str,
+            submitted: float,
+            expectation: Callable[[anki.Vehicle], bool]|None = None,
+            slot: Hashable = None
+        ):
+        """
+        Records that a vehicle acknowledged a command. Must be called on the event loop.
+
+        :param expectation: Whether the telemetry of a vehicle reflects the command
+        :param slot: Waiting for the telemetry of an earlier command of the same slot is given up
+        """
+        now = time.perf_counter()
+        with self._lock:
+            self._histogram(vehicle.id, command, "ack").add(now-submitted)
+        if expectation is None:
+            return
+        # The state when the command was acknowledged includes the speed set along with it,
+        # telemetry only counts once the reported values differ from it
+        self._watched[(vehicle, slot)] = (command, submitted, now, _reportedState(vehicle), expectation)
+        if self._poller is None or self._poller.done():
+            self._poller = self._eventLoop.create_task(self._poll())
+
+    async def _poll(self):
+        while self._watched:
+            await asyncio.sleep(self.pollInterval)
+            now = time.perf_counter()
+            for key, (command, submitted, acknowledged, state, expectation) in list(self._watched.items()):
+                vehicle = key[0]
+                if _reportedState(vehicle) != state and expectation(vehicle):
+                    with self._lock:
+                        self._histogram(vehicle.id, command, "telemetry").add(now-submitted)
+                elif now-acknowledged > self.telemetryTimeout:
+                    with self._lock:
+                        self._histogram(vehicle.id, command, "telemetry").timeouts += 1
+                else:
+                    continue
+                del self._watched[key]
+
+    def histogram(
+            self,
+            vehicleId: Any = None,
+            command: str|None = None,
+            stage: str = "ack"
+        ) -> LatencyHistogram:
+        """
+        The latencies of a stage (see `STAGES`),
+        merged over all vehicles and commands unless they are given
+        """
+        merged = LatencyHistogram()
+        with self._lock:
+            for (id, name, histogramStage), histogram in self._histograms.items():
+                if (
+                    histogramStage == stage
+                    and (vehicleId is None or id == vehicleId)
+                    and (command is None or name == command)
+                ):
+                    merged.merge(histogram)
+        return merged
+
+    def histograms(self) -> dict[tuple[Any, str, str], LatencyHistogram]:
+        """Copies of all histograms by vehicle id, command and stage"""
+        with self._lock:
+            return {key: histogram.copy() for key, histogram in self._histograms.items()}
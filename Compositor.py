@@ -0,0 +1,139 @@
+import time
+from typing import Any, Callable
+import pygame
+
+
+class Layer:
+    """
+    A cached surface drawn at a fixed position of the Ui.
+
+    The surface is only re-rendered when the layer has been invalidated,
+    either explicitly or because the value returned by `key` changed.
+    Layers that update parts of their surface themselves
+    report the changed areas with `damage` instead.
+    """
+    def __init__(
+            self,
+            render: Callable[[], pygame.Surface],
+            pos: tuple[int, int] = (0, 0),
+            key: Callable[[], Any]|None = None
+        ) -> None:
+        self._render = render
+        self._key = key
+        self._lastKey: Any = None
+        self.pos = pos
+        self.surf: pygame.Surface|None = None
+        self.dirty = True
+        self.visible = True
+        self._damage: list[pygame.Rect] = []
+
+    @property
+    def rect(self) -> pygame.Rect|None:
+        if self.surf is None or not self.visible:
+            return None
+        return self.surf.get_rect(topleft=self.pos)
+
+    def invalidate(self):
+        self.dirty = True
+
+    def damage(self, rect: pygame.Rect):
+        """Marks an area of the surface (in layer coordinates) that was changed in place"""
+        self._damage.append(pygame.Rect(rect).move(self.pos))
+
+    def refresh(self) -> list[pygame.Rect]:
+        """Re-renders the layer if needed and returns the rects it damaged"""
+        if self._key is not None:
+            key = self._key()
+            if key != self._lastKey:
+                self._lastKey = key
+                self.dirty = True
+        if not self.dirty:
+            damage, self._damage = self._damage, []
+            return damage if self.rect is not None else []
+        self.dirty = False
+        self._damage = []
+        old = self.rect
+        self.surf = self._render()
+        return [rect for rect in (old, self.rect) if rect is not None]
+
+
+class Compositor:
+    """
+    Composites a stack of layers onto a target surface.
+
+    Only the areas damaged by re-rendered layers are redrawn.
+    Layers are drawn in the order they were added.
+    The time (in seconds) the last composition spent on each layer is kept in `layerTimes`,
+    the time spent drawing the layers onto the target in `compositeTime`.
+    """
+    def __init__(self, target: pygame.Surface, background: tuple[int, int, int]) -> None:
+        self.target = target
+        self.background = background
+        self._layers: dict[str, Layer] = {}
+        self._fullRedraw = True
+        self.layerTimes: dict[str, float] = {}
+        self.compositeTime = 0.
+
+    def addLayer(
+            self,
+            name: str,
+            render: Callable[[], pygame.Surface],
+            pos: tuple[int, int] = (0, 0),
+            key: Callable[[], Any]|None = None
+        ) -> Layer:
+        layer = Layer(render, pos, key)
+        self._layers[name] = layer
+        return layer
+
+    def __getitem__(self, name: str) -> Layer:
+        return self._layers[name]
+
+    def invalidate(self, name: str):
+        self._layers[name].invalidate()
+
+    def invalidateAll(self):
+        self._fullRedraw = True
+
+    def compose(self) -> list[pygame.Rect]:
+        """
+        Re-renders all dirty layers and redraws the damaged areas of the target.
+
+        Returns the list of damaged rects,
+        which can be passed to `pygame.display.update`.
+        """
+        damage: list[pygame.Rect] = []
+        for name, layer in self._layers.items():
+            start = time.perf_counter()
+            damage.extend(layer.refresh())
+            self.layerTimes[name] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        bounds = self.target.get_rect()
+        if self._fullRedraw:
+            self._fullRedraw = False
+            damage = [bounds]
+        damage = _mergeRects([rect.clip(bounds) for rect in damage])
+
+        for rect in damage:
+            self.target.set_clip(rect)
+            self.target.fill(self.background)
+            for layer in self._layers.values():
+                if layer.visible and layer.surf is not None:
+                    self.target.blit(layer.surf, layer.pos)
+        self.target.set_clip(None)
+        self.compositeTime = time.perf_counter() - start
+        return damage
+
+
+def _mergeRects(rects: list[pygame.Rect]) -> list[pygame.Rect]:
+    # Merges overlapping rects so no area is drawn twice
+    merged: list[pygame.Rect] = []
+    for rect in rects:
+        if rect.width == 0 or rect.height == 0:
+            continue
+        index = rect.collidelist(merged)
+        while index != -1:
+            rect = rect.union(merged.pop(index))
+            index = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
@@ -15,5 +15,6 @@ class Design:
     ShowOutlines:bool = True
     ShowCarNumOnMap: bool = True
     ShowCarOnStreet: bool = True
+    ShowPerformanceHud: bool = False #toggled with F3
     Font: str = "Arial"
     FontSize: int = 20
\ No newline at end of file
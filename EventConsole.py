@@ -0,0 +1,120 @@
+import collections
+import logging
+from dataclasses import dataclass
+import pygame
+
+Color = tuple[int, int, int]
+
+
+@dataclass(slots=True)
+class ConsoleLine:
+    text: str
+    color: Color
+    severity: int
+    surf: pygame.Surface|None = None
+    """The rendered line, created when it is first shown"""
+
+
+@dataclass(slots=True)
+class EventStats:
+    """
+    Counters of an event console.
+    `dropped` counts events that were pushed faster than they were drained,
+    `evicted` the lines that left the scrollback.
+    """
+    received: int = 0
+    dropped: int = 0
+    evicted: int = 0
+    pending: int = 0
+    stored: int = 0
+
+
+class EventConsole:
+    """
+    A console of event lines, newest first.
+
+    Events can be pushed from any thread. They wait in a bounded queue
+    until the render thread drains them into the scrollback, which keeps
+    the last `scrollback` lines. Each line is only rendered once.
+    Lines below `minSeverity` (see the `logging` levels) are hidden.
+    """
+    def __init__(self, capacity: int = 1024, scrollback: int = 1000) -> None:
+        # Appending to and popping from a deque is atomic, so pushing needs no lock
+        self._pending: collections.deque[ConsoleLine] = collections.deque(maxlen=capacity)
+        self._lines: collections.deque[ConsoleLine] = collections.deque(maxlen=scrollback)
+        self._received = 0
+        self._dropped = 0
+        self._evicted = 0
+        self._renderedWith: tuple = ()
+        self.minSeverity = logging.NOTSET
+        self.scroll = 0
+        """The number of (shown) lines scrolled past"""
+
+    def push(self, text: str, color: Color, severity: int = logging.INFO):
+        if len(self._pending) == self._pending.maxlen:
+            # The oldest pending event is pushed out
+            self._dropped += 1
+        self._pending.append(ConsoleLine(text, color, severity))
+        self._received += 1
+
+    def drain(self) -> bool:
+        """Moves the pushed events into the scrollback. Returns whether there were any"""
+        drained = False
+        while True:
+            try:
+                line = self._pending.popleft()
+            except IndexError:
+                return drained
+            if len(self._lines) == self._lines.maxlen:
+                self._evicted += 1
+            self._lines.appendleft(line)
+            drained = True
+
+    def stats(self) -> EventStats:
+        return EventStats(
+            self._received,
+            self._dropped,
+            self._evicted,
+            len(self._pending),
+            len(self._lines)
+        )
+
+    def scrollBy(self, lines: int):
+        shown = sum(1 for line in self._lines if line.severity >= self.minSeverity)
+        self.scroll = min(max(self.scroll + lines, 0), max(shown-1, 0))
+
+    def render(
+            self,
+            surf: pygame.Surface,
+            font: pygame.font.Font,
+            fill: Color,
+            separator: Color|None = None,
+            separatorWidth: int = 1
+        ):
+        """
+        Draws the shown lines onto surf.
+
+        :param separator: The colour of the lines drawn between events, if any
+        """
+        if self._renderedWith != (font, fill):
+            # Lines rendered with another font or background are rendered again
+            self._renderedWith = (font, fill)
+            for line in self._lines:
+                line.surf = None
+        surf.fill(fill)
+        y = 0
+        skip = self.scroll
+        for line in self._lines:
+            if y >= surf.get_height():
+                break
+            if line.severity < self.minSeverity:
+                continue
+            if skip > 0:
+                skip -= 1
+                continue
+            if line.surf is None:
+                line.surf = font.render(line.text, True, line.color, fill)
+            surf.blit(line.surf, (10, y))
+            if separator is not None and y > 0:
+                pygame.draw.rect(surf, separator, (0, y, surf.get_width(), separatorWidth))
+            y += line.surf.get_height()
@@ -0,0 +1,334 @@
+import asyncio
+import concurrent.futures
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Hashable, Iterable
+
+import anki
+from anki.misc.lanes import BaseLane
+
+from CommandLatency import CommandLatency
+
+SPEED_TOLERANCE = 30
+"""How close (in mm/s) a reported speed must be to the target to reflect a speed change"""
+LANE_TOLERANCE = 10
+"""How close (in mm) a reported road offset must be to a lane to reflect a lane change"""
+
+
+@dataclass(slots=True)
+class CommandResult:
+    """
+    The outcome of a command for one vehicle.
+    `latency` is the time (in seconds) from sending the command to the vehicle
+    until it completed or failed.
+    Commands that weren't sent are `skipped`, either because a newer command
+    replaced them ("superseded") or because the vehicle already got them ("redundant").
+    Commands cancelled by a pre-empting one fail with a `asyncio.CancelledError`.
+    """
+    index: int
+    vehicleId: Any
+    result: Any = None
+    error: BaseException|None = None
+    latency: float = 0
+    skipped: str|None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass(slots=True)
+class FleetResult:
+    """
+    The outcome of a command sent to several vehicles.
+    `latency` is the time (in seconds) from submitting the command until all vehicles were done,
+    `dispatchDelay` the part of it spent waiting for the event loop.
+    """
+    command: str
+    results: list[CommandResult] = field(default_factory=list)
+    latency: float = 0
+    dispatchDelay: float = 0
+
+    @property
+    def ok(self) -> bool:
+        return all(result.ok for result in self.results)
+
+    @property
+    def failures(self) -> list[CommandResult]:
+        return [result for result in self.results if not result.ok]
+
+    @property
+    def sent(self) -> int:
+        return sum(1 for result in self.results if result.skipped is None)
+
+
+class _VehicleQueue:
+    # The commands of one vehicle waiting to be sent and what it acknowledged
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.pending: dict[str, object] = {}
+        """The newest waiting command of each slot"""
+        self.acknowledged: dict[str, Hashable] = {}
+        self.lastSent = float("-inf")
+        self.running: set[asyncio.Task] = set()
+        """Slotless commands in progress, they don't hold the lock"""
+        self.preemptions = 0
+        """Commands submitted before the latest pre-empting one are superseded"""
+
+
+class FleetCommands:
+    """
+    Sends commands to many vehicles at once.
+
+    Each command is one coroutine on the event loop that starts the commands
+    of all chosen vehicles together, so they don't start staggered.
+    Commands can be sent from any thread and return a `concurrent.futures.Future`
+    of the `FleetResult`. Coroutines on the event loop should await it with
+    `asyncio.wrap_future` instead of blocking on it.
+    Vehicles are chosen by their index, by default all of them are.
+
+    The radio link is slow, so each vehicle gets one command at a time
+    and at most one every `minInterval` seconds.
+    Commands of the same slot (e.g. speed changes) replace each other while they wait,
+    and commands matching the state a vehicle last acknowledged aren't sent at all,
+    as long as its telemetry still agrees.
+    Slotless commands (like align) can take long, so they only wait their turn to start.
+    `stop` pre-empts everything else.
+    The latencies of sent commands are measured by `latency`.
+    """
+    def __init__(
+            self,
+            vehicles: list[anki.Vehicle],
+            eventLoop: asyncio.AbstractEventLoop,
+            minInterval: float = 0.05
+        ) -> None:
+        self._vehicles = vehicles
+        self._eventLoop = eventLoop
+        self.minInterval = minInterval
+        self._queues: dict[anki.Vehicle, _VehicleQueue] = {}
+        self.latency = CommandLatency(eventLoop)
+
+    def run(
+            self,
+            name: str,
+            command: Callable[[anki.Vehicle], Awaitable],
+            vehicles: Iterable[int]|None = None,
+            slot: str|None = None,
+            state: Hashable|None = None,
+            expectation: Callable[[anki.Vehicle], bool]|None = None,
+            preempt: bool = False
+        ) -> concurrent.futures.Future[FleetResult]:
+        """
+        Sends a command to the chosen vehicles.
+
+        :param name: The name of the command, as reported in the result
+        :param command: Creates the coroutine to await for a vehicle
+        :param slot: Waiting commands of the same slot are replaced by this one.
+            Commands without a slot may change anything about a vehicle,
+            so nothing counts as acknowledged after them.
+        :param state: The state of the slot after the command,
+            it is skipped if the vehicle already acknowledged it
+        :param expectation: Whether the telemetry of a vehicle reflects the command (see `CommandLatency`)
+        :param preempt: Send right away, ignoring the rate limit.
+            Waiting commands are superseded and running slotless commands cancelled.
+        """
+        submitted = time.perf_counter()
+        if vehicles is None:
+            vehicles = range(len(self._vehicles))
+        # The vehicles are chosen now, in case the list changes until the command runs
+        chosen = [(index, self._vehicles[index]) for index in vehicles]
+        return asyncio.run_coroutine_threadsafe(
+            self._fanOut(name, command, chosen, submitted, slot, state, expectation, preempt),
+            self._eventLoop
+        )
+
+    def forgetState(self, vehicles: Iterable[int]|None = None):
+        """
+        Forgets what the vehicles acknowledged, e.g. after they were controlled elsewhere.
+        Must be called on the event loop.
+        """
+        if vehicles is None:
+            vehicles = range(len(self._vehicles))
+        for index in vehicles:
+            queue = self._queues.get(self._vehicles[index])
+            if queue is not None:
+                queue.acknowledged.clear()
+
+    async def _fanOut(
+            self,
+            name: str,
+            command: Callable[[anki.Vehicle], Awaitable],
+            chosen: list[tuple[int, anki.Vehicle]],
+            submitted: float,
+            slot: str|None,
+            state: Hashable|None,
+            expectation: Callable[[anki.Vehicle], bool]|None,
+            preempt: bool
+        ) -> FleetResult:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(
+            self._runOne(name, command, index, vehicle, submitted, started, slot, state, expectation, preempt)
+            for index, vehicle in chosen
+        ))
+        return FleetResult(name, list(results), time.perf_counter()-submitted, started-submitted)
+
+    async def _runOne(
+            self,
+            name: str,
+            command: Callable[[anki.Vehicle], Awaitable],
+            index: int,
+            vehicle: anki.Vehicle,
+            submitted: float,
+            started: float,
+            slot: str|None,
+            state: Hashable|None,
+            expectation: Callable[[anki.Vehicle], bool]|None,
+            preempt: bool
+        ) -> CommandResult:
+        result = CommandResult(index, vehicle.id)
+        queue = self._queues.setdefault(vehicle, _VehicleQueue())
+        if preempt:
+            queue.preemptions += 1
+            for running in queue.running:
+                running.cancel(f"Pre-empted by {name}")
+            task = self._dispatch(queue, command, vehicle, slot)
+            await self._complete(result, queue, task, name, vehicle, submitted, slot, state, expectation)
+            result.latency = time.perf_counter()-started
+            return result
+        if (
+            not queue.lock.locked() and slot not in queue.pending
+            and self._isRedundant(queue, vehicle, slot, state, expectation)
+        ):
+            result.skipped = "redundant"
+            return result
+        ticket = object()
+        generation = queue.preemptions
+        if slot is not None:
+            queue.pending[slot] = ticket
+        current = lambda: queue.pending.get(slot, ticket) is ticket and queue.preemptions == generation
+        task = None
+        async with queue.lock:
+            # Waiting may take a while, newer commands of the slot replace this one meanwhile
+            wait = queue.lastSent + self.minInterval - time.perf_counter()
+            if wait > 0 and current():
+                await asyncio.sleep(wait)
+            if not current():
+                if queue.pending.get(slot) is ticket:
+                    del queue.pending[slot]
+                result.skipped = "superseded"
+            elif self._isRedundant(queue, vehicle, slot, state, expectation):
+                del queue.pending[slot]
+                result.skipped = "redundant"
+            else:
+                queue.pending.pop(slot, None)
+                task = self._dispatch(queue, command, vehicle, slot)
+                if slot is not None:
+                    await self._complete(result, queue, task, name, vehicle, submitted, slot, state, expectation)
+        if task is not None and slot is None:
+            # Slotless commands may take long (align waits for the start piece),
+            # so later commands don't wait for them
+            await self._complete(result, queue, task, name, vehicle, submitted, slot, state, expectation)
+        result.latency = time.perf_counter()-started
+        return result
+
+    def _isRedundant(
+            self,
+            queue: _VehicleQueue,
+            vehicle: anki.Vehicle,
+            slot: str|None,
+            state: Hashable|None,
+            expectation: Callable[[anki.Vehicle], bool]|None
+        ) -> bool:
+        # Whether the vehicle acknowledged state last and its telemetry still agrees
+        if slot is None or state is None or queue.acknowledged.get(slot) != state:
+            return False
+        if expectation is not None and not expectation(vehicle):
+            # The vehicle changed some other way since
+            del queue.acknowledged[slot]
+            return False
+        return True
+
+    def _dispatch(
+            self,
+            queue: _VehicleQueue,
+            command: Callable[[anki.Vehicle], Awaitable],
+            vehicle: anki.Vehicle,
+            slot: str|None
+        ) -> asyncio.Task:
+        queue.lastSent = time.perf_counter()
+        task = asyncio.ensure_future(command(vehicle))
+        if slot is None:
+            # Commands without a slot may change anything about the vehicle
+            queue.acknowledged.clear()
+            queue.running.add(task)
+            task.add_done_callback(queue.running.discard)
+        return task
+
+    async def _complete(
+            self,
+            result: CommandResult,
+            queue: _VehicleQueue,
+            task: asyncio.Task,
+            name: str,
+            vehicle: anki.Vehicle,
+            submitted: float,
+            slot: str|None,
+            state: Hashable|None,
+            expectation: Callable[[anki.Vehicle], bool]|None
+        ):
+        # Waits for a sent command and records its outcome.
+        # A failing vehicle must not keep the others from being reported
+        await asyncio.wait((task,))
+        if task.cancelled():
+            result.error = asyncio.CancelledError(f"{name} was pre-empted")
+        elif task.exception() is not None:
+            result.error = task.exception()
+            queue.acknowledged.pop(slot, None)
+        else:
+            result.result = task.result()
+            if slot is None:
+                queue.acknowledged.clear()
+            elif state is not None:
+                queue.acknowledged[slot] = state
+            else:
+                queue.acknowledged.pop(slot, None)
+            self.latency.acknowledged(vehicle, name, submitted, expectation, slot)
+
+    def setSpeed(
+            self,
+            speed: int,
+            acceleration: int = 500,
+            vehicles: Iterable[int]|None = None
+        ) -> concurrent.futures.Future[FleetResult]:
+        return self.run(
+            "setSpeed",
+            lambda vehicle: vehicle.set_speed(speed, acceleration),
+            vehicles, "speed", ("setSpeed", speed, acceleration),
+            lambda vehicle: abs((vehicle.speed or 0) - speed) <= SPEED_TOLERANCE
+        )
+
+    def stop(self, vehicles: Iterable[int]|None = None) -> concurrent.futures.Future[FleetResult]:
+        """Stops the vehicles right away, cancelling waiting speed changes and alignments"""
+        return self.run(
+            "stop", lambda vehicle: vehicle.stop(), vehicles, "speed", ("stop",),
+            lambda vehicle: abs(vehicle.speed or 0) <= SPEED_TOLERANCE,
+            preempt=True
+        )
+
+    def changeLane(
+            self,
+            lane: BaseLane,
+            horizontalSpeed: int = 300,
+            horizontalAcceleration: int = 300,
+            vehicles: Iterable[int]|None = None
+        ) -> concurrent.futures.Future[FleetResult]:
+        return self.run(
+            "changeLane",
+            lambda vehicle: vehicle.change_lane(lane, horizontalSpeed, horizontalAcceleration),
+            vehicles, "lane", (lane, horizontalSpeed, horizontalAcceleration),
+            lambda vehicle: vehicle.road_offset is not None
+                and abs(vehicle.road_offset - lane.value) <= LANE_TOLERANCE
+        )
+
+    def align(self, speed: int = 300, vehicles: Iterable[int]|None = None) -> concurrent.futures.Future[FleetResult]:
+        return self.run("align", lambda vehicle: vehicle.align(speed), vehicles)
@@ -0,0 +1,100 @@
+import math
+from dataclasses import dataclass
+
+from VehicleSnapshot import VehicleSnapshot
+
+FULL_ACTIVITY_SPEED = 1000
+"""The speed (in mm/s) at which vehicles are drawn at the maximum frame rate"""
+LANE_CHANGE_OFFSET = 5
+"""The change of road offset (in mm) between frames counted as changing lanes"""
+
+
+@dataclass(slots=True)
+class PacingStats:
+    """
+    Statistics of the frames paced so far.
+    Rates are the frame rates chosen by the pacer,
+    frame times the seconds it took to draw a frame.
+    `limitedFrames` counts the frames at which the frame time budget lowered the rate.
+    """
+    frames: int = 0
+    minRate: float = 0
+    meanRate: float = 0
+    maxRate: float = 0
+    meanFrameTime: float = 0
+    maxFrameTime: float = 0
+    limitedFrames: int = 0
+
+
+class FramePacer:
+    """
+    Chooses the frame rate from the activity of the vehicles.
+
+    Fast or lane changing vehicles are drawn at up to `maxFps`,
+    standing ones at `minFps`.
+    Drawing may only take up `budget` of the time between frames,
+    so the rate backs off when frames become expensive.
+    """
+    def __init__(self, maxFps: float, minFps: float = 2, budget: float = 0.5) -> None:
+        self.maxFps = maxFps
+        self.minFps = minFps
+        self.budget = budget
+        self.rate = maxFps
+        self._offsets: list[float] = []
+        self._frameTime = 0.
+        self._stats = PacingStats(minRate=float("inf"))
+        self._rateSum = 0.
+
+    def activity(self, snapshot: VehicleSnapshot) -> float:
+        """How much is happening on the track, from 0 (nothing moves) to 1"""
+        activity = 0.
+        offsets = snapshot.offsets
+        previous = self._offsets
+        if len(previous) != len(offsets):
+            # Vehicles were added or removed
+            previous = [math.nan]*len(offsets)
+        for offset, before, speed in zip(offsets, previous, snapshot.speeds):
+            # Missing values are NaN, which never count as changing lanes
+            if abs(offset-before) >= LANE_CHANGE_OFFSET:
+                activity = 1.
+            if not math.isnan(speed):
+                activity = max(activity, min(abs(speed)/FULL_ACTIVITY_SPEED, 1.))
+        self._offsets = offsets.tolist()
+        return activity
+
+    def frameDone(self, snapshot: VehicleSnapshot, frameTime: float) -> float:
+        """
+        Updates the rate after a frame was drawn and returns it.
+
+        :param frameTime: The time (in seconds) it took to draw the frame
+        """
+        # Frame times are smoothed, so a single slow frame doesn't halve the rate
+        self._frameTime = frameTime if self._stats.frames == 0 else 0.8*self._frameTime + 0.2*frameTime
+        target = self.minFps + (self.maxFps-self.minFps)*self.activity(snapshot)
+        if target < self.rate:
+            # Slow down gradually, but react to activity immediately
+            target = max(target, 0.8*self.rate)
+        affordable = self.budget/self._frameTime if self._frameTime > 0 else float("inf")
+        limited = affordable < target
+        self.rate = max(min(target, affordable), self.minFps)
+
+        stats = self._stats
+        stats.frames += 1
+        stats.minRate = min(stats.minRate, self.rate)
+        stats.maxRate = max(stats.maxRate, self.rate)
+        self._rateSum += self.rate
+        stats.meanRate = self._rateSum/stats.frames
+        stats.meanFrameTime += (frameTime-stats.meanFrameTime)/stats.frames
+        stats.maxFrameTime = max(stats.maxFrameTime, frameTime)
+        stats.limitedFrames += limited
+        return self.rate
+
+    def stats(self) -> PacingStats:
+        """The statistics of all frames paced so far"""
+        stats = PacingStats(**{
+            field: getattr(self._stats, field)
+            for field in PacingStats.__slots__
+        })
+        if stats.frames == 0:
+            stats.minRate = 0
+        return stats
@@ -0,0 +1,93 @@
+from array import array
+from dataclasses import dataclass, field
+
+FRAME_STAGES = (
+    "snapshot", "map", "events", "carInfo", "carNumbers", "vehicles", "hud",
+    "composite", "display", "wait", "frame"
+)
+"""
+The measured stages of a frame.
+Most are the layers of the Ui, `composite` draws the layers onto the Ui surface
+and `display` shows it (or publishes it, without a window).
+`wait` is the time spent waiting for the next frame, `frame` the time of all other stages.
+"""
+
+
+@dataclass(slots=True)
+class StageStats:
+    """Statistics of the time (in seconds) a stage took per frame"""
+    mean: float = 0
+    p50: float = 0
+    p95: float = 0
+    p99: float = 0
+    max: float = 0
+
+
+@dataclass(slots=True)
+class FrameStats:
+    """Statistics of the recent frames by stage (see `FRAME_STAGES`)"""
+    frames: int = 0
+    stages: dict[str, StageStats] = field(default_factory=dict)
+
+
+class FrameProfiler:
+    """
+    Records how long the stages of the last `capacity` frames took.
+
+    Times are kept in a flat ring buffer with one row per frame,
+    so recording doesn't allocate.
+    A frame starts with `beginFrame` and is complete when the next one begins.
+    """
+    def __init__(self, capacity: int = 600) -> None:
+        self.capacity = capacity
+        self._stageIndex = {stage: i for i, stage in enumerate(FRAME_STAGES)}
+        self._times = array("d", bytes(8*capacity*len(FRAME_STAGES)))
+        self._row = -1
+        self.frames = 0
+        """The number of completed frames"""
+
+    def beginFrame(self):
+        stages = len(FRAME_STAGES)
+        if self._row >= 0:
+            # The previous frame is done, its total leaves out waiting
+            start = self._row*stages
+            self._times[start+stages-1] = sum(self._times[start:start+stages-2])
+            self.frames += 1
+        self._row = (self._row+1) % self.capacity
+        start = self._row*stages
+        for i in range(start, start+stages):
+            self._times[i] = 0
+
+    def record(self, stage: str, seconds: float):
+        """Adds to the time of a stage in the current frame"""
+        if self._row >= 0:
+            self._times[self._row*len(FRAME_STAGES) + self._stageIndex[stage]] += seconds
+
+    def recent(self, stage: str = "frame", count: int|None = None) -> list[float]:
+        """The times of a stage in the last count completed frames, oldest first"""
+        stored = min(self.frames, self.capacity-1)
+        if count is None or count > stored:
+            count = stored
+        stages = len(FRAME_STAGES)
+        index = self._stageIndex[stage]
+        return [
+            self._times[((self._row-i) % self.capacity)*stages + index]
+            for i in range(count, 0, -1)
+        ]
+
+    def stats(self) -> FrameStats:
+        stats = FrameStats(self.frames)
+        for stage in FRAME_STAGES:
+            times = sorted(self.recent(stage))
+            if not times:
+                stats.stages[stage] = StageStats()
+                continue
+            percentile = lambda p: times[min(int(p/100*len(times)), len(times)-1)]
+            stats.stages[stage] = StageStats(
+                sum(times)/len(times),
+                percentile(50),
+                percentile(95),
+                percentile(99),
+                times[-1]
+            )
+        return stats
@@ -0,0 +1,61 @@
+import bisect
+import math
+from typing import Iterable
+
+from anki.misc.lanes import BaseLane
+
+
+class LaneTable:
+    """
+    A lane system compiled for fast lookups.
+
+    The lanes are sorted by their offset, so finding the closest lane
+    is a bisection over the boundaries between neighbouring lanes.
+    The results match `BaseLane.get_closest_lane`,
+    including which lane wins when an offset is exactly between two.
+    Lists of lanes (e.g. from several lane systems) work too, their first lanes win ties.
+    """
+    def __init__(self, laneSystem: type[BaseLane]|Iterable[BaseLane]) -> None:
+        self.laneSystem = laneSystem
+        self.lanes: list[BaseLane] = list(laneSystem)
+        """The lanes in definition order, lane indices refer to this list"""
+        self._byName: dict[str, BaseLane] = {}
+        for lane in self.lanes:
+            self._byName.setdefault(lane.name, lane)
+        self._sorted = sorted(range(len(self.lanes)), key=lambda i: (self.lanes[i].value, i))
+        # Plain floats, reading the values of enum members is slow
+        self._values = [float(self.lanes[i].value) for i in self._sorted]
+        self._boundaries = [(low+high)/2 for low, high in zip(self._values, self._values[1:])]
+
+    def __len__(self) -> int:
+        return len(self.lanes)
+
+    def index(self, offset: float|None) -> int:
+        """The index of the lane closest to offset, -1 if there is no offset or there are no lanes"""
+        if offset is None or math.isnan(offset) or not self.lanes:
+            return -1
+        values, order = self._values, self._sorted
+        best = bisect.bisect_left(self._boundaries, offset)
+        distance = abs(offset - values[best])
+        # Rounding at the boundaries is settled by comparing the neighbours,
+        # like get_closest_lane does (the first defined lane wins ties)
+        for neighbour in (best-1, best+1):
+            if 0 <= neighbour < len(values):
+                other = abs(offset - values[neighbour])
+                if other < distance or (other == distance and order[neighbour] < order[best]):
+                    best, distance = neighbour, other
+        return order[best]
+
+    def byName(self, name: str) -> BaseLane:
+        """
+        Returns the first lane called name.
+
+        Raises
+        ------
+        :class:`ValueError`
+            There is no lane of that name
+        """
+        try:
+            return self._byName[name]
+        except KeyError as e:
+            raise ValueError("Lane does not exist for the chosen type") from e
@@ -0,0 +1,229 @@
+import os
+import mmap
+import warnings
+import struct
+import hashlib
+from array import array
+
+import pygame
+from anki import TrackPiece
+
+try:
+    from .VisMapGenerator import CompactVismap
+    from .Design import Design
+except ImportError:
+    from VisMapGenerator import CompactVismap
+    from Design import Design
+
+CACHE_VERSION = 2
+"""Entries written with a different version are ignored and removed"""
+
+_LAYOUT_MAGIC = b"AUIL"
+_SURFACE_MAGIC = b"AUIS"
+_HEADER = struct.Struct("<4sIIIII")
+# magic, version and four sizes (their meaning depends on the entry type)
+
+_DESIGN_FIELDS = ("Line", "LineWidth", "ShowGrid", "ShowOutlines")
+"""The fields of Design that change the pre-rendered map surface"""
+
+_COLUMNS = ("x", "y", "layer", "piece_index", "piece_type", "orientation", "rotation")
+
+_PIXEL_FORMATS = ("BGRA", "RGBA", "ARGB")
+"""The byte orders map surfaces can be stored in, the header stores an index into this"""
+
+
+def _nativeFormat() -> str|None:
+    # The byte order of the surfaces the Ui draws on, pixels stored in it blit without conversion
+    masks = pygame.Surface((1, 1), pygame.SRCALPHA).get_masks()
+    for name in _PIXEL_FORMATS:
+        if pygame.image.frombuffer(bytearray(4), (1, 1), name).get_masks() == masks:
+            return name
+    return None
+
+
+class LayoutCache:
+    """
+    A persistent cache of generated layouts and pre-rendered map surfaces.
+
+    Entries are keyed by a hash of the track, the orientation and flipping
+    (and the design, for map surfaces). Map surfaces are stored as raw pixels
+    that are memory-mapped when loaded.
+    When the cache grows beyond `maxBytes`, the least recently used entries are removed.
+    The cache fails soft: unreadable entries count as misses
+    and entries that can't be written are skipped with a warning.
+    """
+    def __init__(self, directory: str, maxBytes: int = 64*1024*1024) -> None:
+        self.directory = directory
+        self.maxBytes = maxBytes
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            warnings.warn(f"Can't create the layout cache: {e}", RuntimeWarning)
+
+    @staticmethod
+    def layoutKey(
+            track_map: list[TrackPiece],
+            orientation: tuple[int, int],
+            flip_horizontal: bool
+        ) -> str:
+        digest = hashlib.sha256()
+        digest.update(repr((
+            CACHE_VERSION,
+            [(piece.loc, piece.type.name, piece.clockwise) for piece in track_map],
+            tuple(orientation),
+            flip_horizontal
+        )).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def surfaceKey(layoutKey: str, design: Design) -> str:
+        digest = hashlib.sha256()
+        digest.update(repr((
+            layoutKey,
+            [getattr(design, field) for field in _DESIGN_FIELDS]
+        )).encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.directory, key + suffix)
+
+    def _open(self, path: str, magic: bytes) -> tuple[tuple[int, ...], mmap.mmap]|None:
+        # Maps a cache file and checks its header. Outdated entries are removed
+        try:
+            with open(path, "rb") as file:
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (OSError, ValueError):
+            return None
+        header = _HEADER.unpack_from(mapped) if len(mapped) >= _HEADER.size else None
+        if header is None or header[0] != magic or header[1] != CACHE_VERSION:
+            mapped.close()
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            # Read-only caches just lose the recency of their entries
+            pass
+        return header[2:], mapped
+
+    def _write(self, path: str, data: list[bytes]):
+        temp = path + ".tmp"
+        try:
+            with open(temp, "wb") as file:
+                for chunk in data:
+                    file.write(chunk)
+            os.replace(temp, path)
+        except OSError as e:
+            warnings.warn(f"Can't write to the layout cache: {e}", RuntimeWarning)
+            self._remove(temp)
+            return
+        self._evict()
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            # Files still mapped by another process can't always be removed
+            pass
+
+    def _evict(self):
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if not name.endswith((".layout", ".pixels")):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Another process removed it meanwhile
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.maxBytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def loadLayout(self, key: str, track_map: list[TrackPiece]) -> CompactVismap|None:
+        opened = self._open(self._path(key, ".layout"), _LAYOUT_MAGIC)
+        if opened is None:
+            return None
+        (width, height, elements, positions), mapped = opened
+        path = self._path(key, ".layout")
+        with mapped:
+            compact = CompactVismap(width, height)
+            offset = _HEADER.size
+            for name, count in (
+                    *((column, elements) for column in _COLUMNS),
+                    ("cell_start", width*height+1),
+                    ("position_element", positions)
+                ):
+                column: array = getattr(compact, name)
+                size = column.itemsize*count
+                if offset+size > len(mapped):
+                    # Truncated entry
+                    self._remove(path)
+                    return None
+                column.frombytes(mapped[offset:offset+size])
+                offset += size
+        try:
+            compact.pieces = [track_map[position] for position in compact.piece_index]
+        except IndexError:
+            self._remove(path)
+            return None
+        return compact
+
+    def storeLayout(self, key: str, compact: CompactVismap):
+        self._write(self._path(key, ".layout"), [
+            _HEADER.pack(
+                _LAYOUT_MAGIC,
+                CACHE_VERSION,
+                compact.width,
+                compact.height,
+                len(compact),
+                len(compact.position_element)
+            ),
+            *(getattr(compact, name).tobytes() for name in _COLUMNS),
+            compact.cell_start.tobytes(),
+            compact.position_element.tobytes()
+        ])
+
+    def loadSurface(self, key: str) -> pygame.Surface|None:
+        """
+        Loads a map surface without copying its pixels.
+        The surface keeps the memory-mapped file alive.
+        """
+        opened = self._open(self._path(key, ".pixels"), _SURFACE_MAGIC)
+        if opened is None:
+            return None
+        (width, height, pixelFormat, _), mapped = opened
+        native = _nativeFormat()
+        if native is None or pixelFormat != _PIXEL_FORMATS.index(native):
+            # Stored by a platform with another byte order, it's regenerated
+            mapped.close()
+            return None
+        if len(mapped) < _HEADER.size+width*height*4:
+            mapped.close()
+            self._remove(self._path(key, ".pixels"))
+            return None
+        return pygame.image.frombuffer(
+            memoryview(mapped)[_HEADER.size:_HEADER.size+width*height*4],
+            (width, height),
+            native
+        )
+
+    def storeSurface(self, key: str, surf: pygame.Surface):
+        native = _nativeFormat()
+        if native is None:
+            return
+        width, height = surf.get_size()
+        self._write(self._path(key, ".pixels"), [
+            _HEADER.pack(_SURFACE_MAGIC, CACHE_VERSION, width, height, _PIXEL_FORMATS.index(native), 0),
+            pygame.image.tobytes(surf, native)
+        ])
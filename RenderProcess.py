@@ -0,0 +1,464 @@
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import math
+import multiprocessing
+import struct
+import threading
+import warnings
+from array import array
+from multiprocessing import shared_memory
+from multiprocessing.connection import Connection
+from typing import Any, BinaryIO, Iterable
+
+import anki
+from anki import TrackPiece
+from anki.misc.lanes import BaseLane
+
+from Design import Design
+from EventConsole import EventStats
+from FleetCommands import FleetCommands
+from FramePacer import PacingStats
+from FrameProfiler import FrameStats
+from LayoutCache import LayoutCache
+from TelemetryLog import TelemetryRecorder
+from UiMain import Ui, _buildLaneSystem
+from VehicleSnapshot import VehicleSnapshot
+from VisMapGenerator import PIECE_TYPES
+
+_SLOT_HEADER = struct.Struct("<QI4x")
+# version (odd while the slot is written) and vehicle count
+_RING_HEADER = struct.Struct("<Q")
+# the sequence number of the latest snapshot
+_COLUMNS = (("offset", "d"), ("speed", "d"), ("position", "i"), ("piece", "i"))
+"""The per-vehicle columns of a snapshot. Missing values are NaN or -1"""
+
+SNAPSHOT_SLOTS = 4
+
+
+class SnapshotRing:
+    """
+    A ring of vehicle snapshots in shared memory.
+
+    One process writes snapshots, another one reads the latest of them.
+    Each slot carries a version that is odd while the slot is written,
+    so readers can tell torn snapshots apart and retry.
+    """
+    def __init__(self, capacity: int, name: str|None = None, slots: int = SNAPSHOT_SLOTS) -> None:
+        self.capacity = capacity
+        self.slots = slots
+        self._slotSize = _SLOT_HEADER.size + capacity*sum(
+            array(typecode).itemsize for _, typecode in _COLUMNS
+        )
+        size = _RING_HEADER.size + slots*self._slotSize
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            self.memory.buf[:size] = bytes(size)
+        else:
+            self.memory = shared_memory.SharedMemory(name)
+        self.name = self.memory.name
+        self._sequence = 0
+
+    def _slot(self, sequence: int) -> tuple[int, dict[str, memoryview]]:
+        # The offset of a slot and views of its columns
+        start = _RING_HEADER.size + (sequence % self.slots)*self._slotSize
+        offset = start + _SLOT_HEADER.size
+        columns = {}
+        for name, typecode in _COLUMNS:
+            size = self.capacity*array(typecode).itemsize
+            columns[name] = self.memory.buf[offset:offset+size].cast(typecode)
+            offset += size
+        return start, columns
+
+    def write(self, columns: dict[str, Iterable]):
+        """Publishes a snapshot made of one sequence per column"""
+        values = {name: array(typecode, columns[name]) for name, typecode in _COLUMNS}
+        count = len(values["position"])
+        if count > self.capacity:
+            raise ValueError(f"Snapshot of {count} vehicles exceeds the capacity of {self.capacity}")
+        sequence = self._sequence + 1
+        start, views = self._slot(sequence)
+        _SLOT_HEADER.pack_into(self.memory.buf, start, 2*sequence+1, count)
+        for name, view in views.items():
+            view[:count] = values[name]
+            view.release()
+        _SLOT_HEADER.pack_into(self.memory.buf, start, 2*sequence, count)
+        _RING_HEADER.pack_into(self.memory.buf, 0, sequence)
+        self._sequence = sequence
+
+    def read(self) -> tuple[int, dict[str, list]]|None:
+        """Returns the sequence number and columns of the latest snapshot, None if there is none"""
+        while True:
+            sequence, = _RING_HEADER.unpack_from(self.memory.buf, 0)
+            if sequence == 0:
+                return None
+            start, views = self._slot(sequence)
+            version, count = _SLOT_HEADER.unpack_from(self.memory.buf, start)
+            columns = {name: view[:count].tolist() for name, view in views.items()}
+            for view in views.values():
+                view.release()
+            if version == 2*sequence and _SLOT_HEADER.unpack_from(self.memory.buf, start)[0] == version:
+                return sequence, columns
+            # The slot was overwritten while it was read
+
+    def close(self, unlink: bool = False):
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+class _SnapshotVehicle:
+    # Stands in for a vehicle of the main process inside the render process
+    def __init__(self, id: Any) -> None:
+        self.id = id
+        self.map_position: int|None = None
+        self.road_offset: float|None = None
+        self.speed: float|None = None
+        self.current_track_piece: TrackPiece|None = None
+
+
+class _ChildUi(Ui):
+    # Opens the vehicle control window in the main process, where the vehicles are
+    _send: Any = None
+
+    def startVehicleControlUI(self):
+        self._send(("controller",))
+
+
+def _renderMain(conn: Connection, ringName: str, capacity: int, ids: list, map: list[TrackPiece], options: dict):
+    asyncio.run(_renderLoop(conn, ringName, capacity, ids, map, options))
+
+
+async def _renderLoop(conn: Connection, ringName: str, capacity: int, ids: list, map: list[TrackPiece], options: dict):
+    sendLock = threading.Lock()
+    def send(message: tuple):
+        with sendLock:
+            conn.send(message)
+
+    ring = SnapshotRing(capacity, ringName)
+    vehicles = [_SnapshotVehicle(id) for id in ids]
+    # The custom lanes are rebuilt, so the lanes found from the offsets match the main process
+    options["customLanes"] = list(BaseLane("RemoteLanes", options["customLanes"]))
+    ui = _ChildUi(vehicles, map, **options)
+    ui._send = send
+    pieces = [TrackPiece(-1, pieceType, False) for pieceType in PIECE_TYPES]
+    await ui.waitForSetupAsync()
+    send(("setup",))
+
+    commands = {
+        "addEvent": ui.addEvent,
+        "scrollEvents": ui.scrollEvents,
+        "setEventFilter": ui.setEventFilter,
+        "setDesign": ui.setDesign,
+        "appendPiece": ui.appendPiece,
+        "setMap": ui.setMap,
+        "removeVehicle": ui.removeVehicle,
+        "toggleHud": ui.toggleHud
+    }
+    queries = {
+        "getFrameStats": ui.getFrameStats,
+        "getEventStats": ui.getEventStats,
+        "getPacingStats": ui.getPacingStats
+    }
+    lastSequence = 0
+    try:
+        while not ui._endFuture.done():
+            while conn.poll():
+                command, *args = conn.recv()
+                if command == "kill":
+                    ui.kill()
+                elif command == "addVehicle":
+                    id, color = args
+                    ui.addVehicle(_SnapshotVehicle(id), color)
+                elif command == "ring":
+                    ring.close()
+                    ring = SnapshotRing(*args)
+                elif command == "query":
+                    id, name = args
+                    send(("reply", id, queries[name]()))
+                else:
+                    commands[command](*args)
+            snapshot = ring.read()
+            if snapshot is not None and snapshot[0] != lastSequence:
+                lastSequence, columns = snapshot
+                for vehicle, offset, speed, position, piece in zip(
+                        ui._vehicles, *(columns[name] for name, _ in _COLUMNS)
+                    ):
+                    vehicle.road_offset = None if math.isnan(offset) else offset
+                    vehicle.speed = None if math.isnan(speed) else speed
+                    vehicle.map_position = None if position < 0 else position
+                    vehicle.current_track_piece = None if piece < 0 else pieces[piece]
+                ui._wake()
+            await asyncio.sleep(1/ui.fps)
+    except (EOFError, OSError):
+        # The main process is gone
+        ui.kill()
+    finished = await ui.waitForFinishAsync(ignoreExceptions=True)
+    error = ui._endFuture.exception()
+    ring.close()
+    try:
+        send(("finished", finished, None if error is None else repr(error)))
+    except (EOFError, OSError):
+        pass
+
+
+class RemoteUi:
+    """
+    A Ui that renders in a separate process.
+
+    Created by `createUi(..., renderProcess=True)` or directly.
+    The vehicles stay in this process. Their state is published
+    as snapshots through shared memory, while events, design and map changes
+    are sent through a pipe.
+    Statistics are queried from the render process, which takes up to a frame.
+    Methods that return surfaces or frames aren't available.
+
+    The render process is spawned, so the main module has to be guarded
+    by `if __name__ == "__main__":` (see the `multiprocessing` documentation).
+    """
+    def __init__(
+            self,
+            vehicles: list[anki.Vehicle],
+            map: list[TrackPiece],
+            *,
+            customLanes: list[BaseLane] = [],
+            design: Design = Design(),
+            vehicleColors: Iterable[tuple[int, int, int]] = [],
+            layoutCache: LayoutCache|str|None = None,
+            showController: bool = False,
+            fps: int = 10,
+            **options
+        ) -> None:
+        self._vehicleColorIterator = itertools.chain(
+            iter(vehicleColors),
+            itertools.repeat((255, 255, 255))
+        )
+        self._vehicles = vehicles
+        self._accumulatedVehicleColors = [
+            next(self._vehicleColorIterator)
+            for _ in range(len(vehicles))
+        ]
+        self._customLanes, self._laneSystem = _buildLaneSystem(customLanes)
+        self._snapshot = VehicleSnapshot(self._laneSystem)
+        # Recordings are taken from the snapshots published to the render process
+        self._recorder: TelemetryRecorder|None = None
+        self._recordLock = threading.Lock()
+        self._map = list(map)
+        self._design = design
+        self.fps = fps
+
+        self._uiSetupComplete = concurrent.futures.Future()
+        self._endFuture = concurrent.futures.Future()
+        self._eventLoop = asyncio.get_running_loop()
+        self.fleet = FleetCommands(self._vehicles, self._eventLoop)
+        self._controlThread = None
+
+        self._ring: SnapshotRing|None = SnapshotRing(max(2*len(vehicles), 16))
+        self._ringLock = threading.Lock()
+        self._conn, childConn = multiprocessing.Pipe()
+        self._sendLock = threading.Lock()
+        # Queries waiting for the reply of the render process
+        self._queries: dict[int, concurrent.futures.Future] = {}
+        self._queryIds = itertools.count()
+        self._queryLock = threading.Lock()
+        options.update(
+            customLanes=[(lane.name, lane.value) for lane in customLanes],
+            design=design,
+            vehicleColors=self._accumulatedVehicleColors,
+            layoutCache=layoutCache,
+            fps=fps
+        )
+        self._process = multiprocessing.get_context("spawn").Process(
+            target=_renderMain,
+            args=(
+                childConn,
+                self._ring.name,
+                self._ring.capacity,
+                [vehicle.id for vehicle in vehicles],
+                list(map),
+                options
+            ),
+            daemon=True
+        )
+        self._process.start()
+        childConn.close()
+        self._publishSnapshot()
+        self._receiver = threading.Thread(target=self._receive, daemon=True)
+        self._receiver.start()
+        self._publisher = self._eventLoop.create_task(self._publish())
+        if showController:
+            self.startVehicleControlUI()
+
+    def _send(self, *message):
+        try:
+            with self._sendLock:
+                self._conn.send(message)
+        except (EOFError, OSError):
+            warnings.warn("The render process has already stopped", RuntimeWarning)
+
+    def _receive(self):
+        # Handles the messages of the render process
+        try:
+            while True:
+                message = self._conn.recv()
+                if message[0] == "setup":
+                    self._uiSetupComplete.set_result(True)
+                elif message[0] == "reply":
+                    _, id, result = message
+                    with self._queryLock:
+                        future = self._queries.pop(id, None)
+                    if future is not None:
+                        future.set_result(result)
+                elif message[0] == "controller":
+                    self._eventLoop.call_soon_threadsafe(self.startVehicleControlUI)
+                elif message[0] == "finished":
+                    _, finished, error = message
+                    # The ring is removed before anyone is told, so it doesn't outlive the program
+                    self._closeRing()
+                    if error is None:
+                        self._endFuture.set_result(finished)
+                    else:
+                        self._endFuture.set_exception(RuntimeError(f"The render process failed: {error}"))
+        except (EOFError, OSError):
+            pass
+        finally:
+            if not self._uiSetupComplete.done():
+                self._uiSetupComplete.set_result(False)
+            if not self._endFuture.done():
+                self._endFuture.set_result(False)
+            with self._queryLock:
+                queries, self._queries = self._queries, {}
+            for future in queries.values():
+                future.set_exception(RuntimeError("The render process has stopped"))
+            self._closeRing()
+            self._process.join()
+
+    def _closeRing(self):
+        with self._ringLock:
+            if self._ring is not None:
+                self._ring.close(unlink=True)
+                self._ring = None
+
+    def _publishSnapshot(self):
+        # Reads the vehicles on the event loop, where their state is changed, so reads aren't torn
+        snapshot = self._snapshot
+        snapshot.capture(self._vehicles)
+        with self._recordLock:
+            if self._recorder is not None:
+                self._recorder.record(snapshot)
+        with self._ringLock:
+            if self._ring is None:
+                # The render process has stopped
+                return
+            if len(self._vehicles) > self._ring.capacity:
+                # The render process switches to a larger ring.
+                # It keeps the old one mapped until then, so it can be unlinked right away
+                self._ring.close(unlink=True)
+                self._ring = SnapshotRing(2*len(self._vehicles))
+                self._send("ring", self._ring.capacity, self._ring.name)
+            self._ring.write({
+                "offset": snapshot.offsets,
+                "speed": snapshot.speeds,
+                "position": snapshot.positions,
+                "piece": snapshot.pieces
+            })
+
+    async def _publish(self):
+        try:
+            while not self._endFuture.done():
+                self._publishSnapshot()
+                await asyncio.sleep(1/self.fps)
+        finally:
+            self.stopRecording()
+
+    def _query(self, name: str, timeout: float = 5):
+        # Returns the result of one of the Ui's getters in the render process
+        future = concurrent.futures.Future()
+        with self._queryLock:
+            id = next(self._queryIds)
+            self._queries[id] = future
+        # Queries registered after the receiver gave up would never be answered
+        if self._endFuture.done():
+            with self._queryLock:
+                self._queries.pop(id, None)
+            raise RuntimeError("The render process has stopped")
+        self._send("query", id, name)
+        try:
+            return future.result(timeout)
+        finally:
+            with self._queryLock:
+                self._queries.pop(id, None)
+
+    def kill(self):
+        self._send("kill")
+    def addEvent(
+            self,
+            text: str,
+            color: tuple[int, int, int]|None = None,
+            severity: int = logging.INFO
+        ):
+        self._send("addEvent", text, color, severity)
+    def scrollEvents(self, lines: int):
+        self._send("scrollEvents", lines)
+    def setEventFilter(self, minSeverity: int):
+        self._send("setEventFilter", minSeverity)
+    def updateDesign(self):
+        self._send("setDesign", self._design)
+    def setDesign(self, design: Design):
+        self._design = design
+        self.updateDesign()
+    def appendPiece(self, piece: TrackPiece):
+        self._map.append(piece)
+        self._send("appendPiece", piece)
+    def setMap(self, map: list[TrackPiece]):
+        self._map = list(map)
+        self._send("setMap", self._map)
+    def addVehicle(
+            self,
+            vehicle: anki.Vehicle,
+            vehicleColor: tuple[int,int,int]|None = None
+        ):
+        if vehicleColor is None:
+            vehicleColor = next(self._vehicleColorIterator)
+        self._vehicles.append(vehicle)
+        self._accumulatedVehicleColors.append(vehicleColor)
+        self._send("addVehicle", vehicle.id, vehicleColor)
+    def removeVehicle(self, index: int):
+        self._vehicles.pop(index)
+        self._accumulatedVehicleColors.pop(index)
+        self._send("removeVehicle", index)
+    def getSnapshot(self) -> VehicleSnapshot:
+        """A copy of the vehicle state last sent to the render process"""
+        return self._snapshot.copy()
+    def startRecording(self, file: str|BinaryIO):
+        """
+        Records the vehicle states of every snapshot sent to the render process
+        and the map to a telemetry log. A running recording is stopped first.
+        """
+        with self._recordLock:
+            if self._recorder is not None:
+                self._recorder.close()
+            self._recorder = TelemetryRecorder(file, self._map, self._snapshot.laneTable)
+    def stopRecording(self):
+        with self._recordLock:
+            if self._recorder is not None:
+                self._recorder.close()
+                self._recorder = None
+    def toggleHud(self):
+        self._send("toggleHud")
+    def getFrameStats(self) -> FrameStats:
+        return self._query("getFrameStats")
+    def getEventStats(self) -> EventStats:
+        return self._query("getEventStats")
+    def getPacingStats(self) -> PacingStats|None:
+        return self._query("getPacingStats")
+
+    startVehicleControlUI = Ui.startVehicleControlUI
+    getCommandLatency = Ui.getCommandLatency
+    waitForFinish = Ui.waitForFinish
+    waitForFinishAsync = Ui.waitForFinishAsync
+    waitForSetup = Ui.waitForSetup
+    waitForSetupAsync = Ui.waitForSetupAsync
+    __enter__ = Ui.__enter__
+    __exit__ = Ui.__exit__
@@ -0,0 +1,240 @@
+import asyncio
+import math
+import struct
+from typing import Any, BinaryIO, Callable, Iterator
+
+from anki import TrackPiece
+from anki.misc.lanes import BaseLane
+
+from LaneTable import LaneTable
+from VehicleSnapshot import VehicleSnapshot
+from VisMapGenerator import PIECE_TYPES
+
+MAGIC = b"ANKITLOG"
+VERSION = 1
+_HEADER = struct.Struct("<8sHHI")
+# magic, version, number of lanes, number of pieces
+_PIECE = struct.Struct("<iii")
+# location, piece type, clockwise
+_LANE = struct.Struct("<32sd")
+# name, offset
+_TIME_ID = struct.Struct("<dq")
+_STATE = struct.Struct("<iiiidd")
+RECORD = struct.Struct(_TIME_ID.format + _STATE.format[1:])
+"""
+The format of a record, one per vehicle state change:
+time (d), vehicle id (q), map position (i), lane (i), piece type (i), flags (i), road offset (d), speed (d).
+A log starts with a header holding the map and the lanes, followed by the records.
+Missing values are -1 or NaN like in `VehicleSnapshot`, lanes index into the lanes
+of the header and piece types into `PIECE_TYPES`.
+"""
+
+REMOVED = 1
+"""Flag of the records of vehicles that were removed from the Ui"""
+
+
+class TelemetryRecorder:
+    """
+    Writes the changes between vehicle snapshots to a log.
+
+    Records are buffered and written every `flushInterval` seconds of recording.
+    Changes of the map after the recording started aren't recorded.
+    """
+    def __init__(
+            self,
+            file: str|BinaryIO,
+            map: list[TrackPiece],
+            laneTable: LaneTable,
+            flushInterval: float = 1
+        ) -> None:
+        self._file: BinaryIO = open(file, "wb") if isinstance(file, str) else file
+        self.flushInterval = flushInterval
+        self._buffer = bytearray()
+        self._start: float|None = None
+        self._lastFlush = 0.
+        self._states: dict[int, bytes] = {}
+        """The last recorded state of each vehicle"""
+        self.records = 0
+
+        self._buffer += _HEADER.pack(MAGIC, VERSION, len(laneTable), len(map))
+        for piece in map:
+            self._buffer += _PIECE.pack(piece.loc, PIECE_TYPES.index(piece.type), piece.clockwise)
+        for lane in laneTable.lanes:
+            self._buffer += _LANE.pack(lane.name.encode(), lane.value)
+        self.flush()
+
+    def record(self, snapshot: VehicleSnapshot):
+        """Records the vehicles whose state differs from the last recorded one"""
+        if self._start is None:
+            self._start = snapshot.time
+        time = snapshot.time - self._start
+        seen = set()
+        for i in range(len(snapshot)):
+            id = snapshot.ids[i]
+            seen.add(id)
+            # States are compared packed, since NaN doesn't equal itself
+            state = _STATE.pack(
+                snapshot.positions[i],
+                snapshot.lanes[i],
+                snapshot.pieces[i],
+                0,
+                snapshot.offsets[i],
+                snapshot.speeds[i]
+            )
+            if self._states.get(id) != state:
+                self._states[id] = state
+                self._buffer += _TIME_ID.pack(time, id) + state
+                self.records += 1
+        for id in [id for id in self._states if id not in seen]:
+            del self._states[id]
+            self._buffer += RECORD.pack(time, id, -1, -1, -1, REMOVED, math.nan, math.nan)
+            self.records += 1
+        if time - self._lastFlush >= self.flushInterval:
+            self._lastFlush = time
+            self.flush()
+
+    def flush(self):
+        self._file.write(self._buffer)
+        self._file.flush()
+        self._buffer.clear()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+
+
+class ReplayVehicle:
+    """A stand-in for `anki.Vehicle` driven by a telemetry log"""
+    def __init__(self, id: int, map: list[TrackPiece]) -> None:
+        self.id = id
+        self._map = map
+        self.map_position: int|None = None
+        self.road_offset: float|None = None
+        self.speed: float|None = None
+        self.lane: str|None = None
+        """The name of the recorded lane"""
+        self._pieceType = -1
+        self._watchers: list[Callable] = []
+
+    @property
+    def current_track_piece(self) -> TrackPiece|None:
+        if self.map_position is not None and self.map_position < len(self._map):
+            return self._map[self.map_position]
+        if self._pieceType < 0:
+            return None
+        return TrackPiece(-1, PIECE_TYPES[self._pieceType], False)
+
+    def get_lane(self, mode: type[BaseLane]) -> BaseLane|None:
+        if self.road_offset is None:
+            return None
+        return mode.get_closest_lane(self.road_offset)
+
+    def track_piece_change(self, func: Callable):
+        self._watchers.append(func)
+        return func
+
+    def remove_track_piece_watcher(self, func: Callable):
+        self._watchers.remove(func)
+
+
+class TelemetryReplay:
+    """
+    Replays a telemetry log through stand-in vehicles.
+
+    `vehicles` holds a stand-in for every vehicle of the log,
+    in the order they first appear, and `map` the recorded map.
+    Both can be passed to a Ui, which then shows the replay:
+
+        replay = TelemetryReplay("race.tlog")
+        ui = Ui(replay.vehicles, replay.map)
+        await replay.play(speed=2)
+    """
+    def __init__(self, file: str|BinaryIO) -> None:
+        if isinstance(file, str):
+            with open(file, "rb") as f:
+                data = f.read()
+        else:
+            data = file.read()
+        magic, version, laneCount, pieceCount = _HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not a telemetry log")
+        if version != VERSION:
+            raise ValueError(f"Unsupported telemetry log version {version}")
+        offset = _HEADER.size
+        self.map: list[TrackPiece] = []
+        for loc, pieceType, clockwise in _PIECE.iter_unpack(data[offset:offset+pieceCount*_PIECE.size]):
+            self.map.append(TrackPiece(loc, PIECE_TYPES[pieceType], bool(clockwise)))
+        offset += pieceCount*_PIECE.size
+        self.lanes: list[tuple[str, float]] = [
+            (name.rstrip(b"\0").decode(), value)
+            for name, value in _LANE.iter_unpack(data[offset:offset+laneCount*_LANE.size])
+        ]
+        offset += laneCount*_LANE.size
+        # A record cut off by a crash is left out
+        end = offset + (len(data)-offset)//RECORD.size*RECORD.size
+        self._records = memoryview(data)[offset:end]
+
+        self.vehicles: list[ReplayVehicle] = []
+        self._byId: dict[int, ReplayVehicle] = {}
+        self.duration = 0.
+        for time, id, *_ in RECORD.iter_unpack(self._records):
+            if id not in self._byId:
+                self._byId[id] = ReplayVehicle(id, self.map)
+                self.vehicles.append(self._byId[id])
+            self.duration = time
+
+    def __len__(self) -> int:
+        return len(self._records)//RECORD.size
+
+    def _groups(self) -> Iterator[tuple[float, list[tuple[Any, ...]]]]:
+        # The records grouped by the time they were recorded at
+        group: list[tuple[Any, ...]] = []
+        for record in RECORD.iter_unpack(self._records):
+            if group and record[0] != group[0][0]:
+                yield group[0][0], group
+                group = []
+            group.append(record)
+        if group:
+            yield group[0][0], group
+
+    def _apply(self, records: list[tuple[Any, ...]]):
+        for _, id, position, lane, pieceType, flags, offset, speed in records:
+            vehicle = self._byId[id]
+            if flags & REMOVED:
+                position = lane = pieceType = -1
+            moved = vehicle.map_position != (None if position < 0 else position)
+            vehicle.map_position = None if position < 0 else position
+            vehicle.road_offset = None if math.isnan(offset) else offset
+            vehicle.speed = None if math.isnan(speed) else speed
+            vehicle.lane = None if lane < 0 or lane >= len(self.lanes) else self.lanes[lane][0]
+            vehicle._pieceType = pieceType
+            if moved:
+                for watcher in list(vehicle._watchers):
+                    watcher()
+
+    def steps(self) -> Iterator[float]:
+        """
+        Applies the records one point in time after another, as fast as they are consumed.
+        Yields the recorded time (in seconds) after each step.
+        """
+        for time, records in self._groups():
+            self._apply(records)
+            yield time
+
+    async def play(self, speed: float|None = 1):
+        """
+        Replays the log on the event loop.
+
+        :param speed: How much faster than recorded to replay,
+            None replays as fast as possible (yielding to the event loop between steps)
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for time, records in self._groups():
+            if speed is None:
+                await asyncio.sleep(0)
+            else:
+                await asyncio.sleep(max(start + time/speed - loop.time(), 0))
+            self._apply(records)
@@ -0,0 +1,278 @@
+"""
+Benchmarks the map generation and rendering stages of the Ui.
+
+No hardware is needed: the tracks are synthetic and the vehicles are stand-ins
+that only have the attributes the Ui reads.
+The Ui runs without a window, so this also works on machines without a display.
+
+Results are written as JSON, so runs on different commits can be compared:
+
+    python Tests/render_benchmark.py --output before.json
+    python Tests/render_benchmark.py --output after.json --compare before.json
+"""
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+import warnings
+from typing import Any, Callable
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+import pygame
+from anki import TrackPiece, TrackPieceType
+
+from VisMapGenerator import generate, flip_h
+from UiMain import Ui
+
+_DIRECTIONS = ((1,0),(0,-1),(-1,0),(0,1))
+# The same order as in VisMapGenerator, turning counterclockwise
+
+STAGES = ("generate", "flip_h", "genMapSurface", "snapshot", "carInfo", "carOnMap", "carOnStreet", "updateUi")
+
+
+def synthetic_track(pieces: int, crossing_intersections: bool = True) -> list[TrackPiece]:
+    """
+    Creates a closed track of roughly `pieces` pieces.
+
+    The track winds through a square area in rows and returns
+    through a column in the middle that crosses every row.
+    With `crossing_intersections` every other crossing is an intersection,
+    the others are stacked straights (like a bridge).
+    Without it, all crossings are stacked straights.
+    """
+    # A track of rows*(width+2) + rows + width pieces, rows must be even
+    rows = max(2, round(pieces**0.5) // 2 * 2)
+    width = max(4, (pieces - rows) // (rows + 1))
+    middle = width // 2
+
+    cells: list[tuple[int,int]] = []
+    for row in range(rows):
+        y = -row
+        if row % 2 == 0:
+            start = 0 if row == 0 else 1
+            cells.extend((x,y) for x in range(start, width+1))
+            cells.append((width,y-1))
+        elif row == rows-1:
+            cells.extend((x,y) for x in range(width-1, middle-1, -1))
+        else:
+            cells.extend((x,y) for x in range(width-1, -1, -1))
+            cells.append((0,y-1))
+    # The column back to the first row
+    cells.extend((middle,y) for y in range(-rows+2, 2))
+    cells.extend((x,1) for x in range(middle-1, -2, -1))
+    cells.append((-1,0))
+
+    crossings = {
+        (middle,-row): row % 2 == 0 and crossing_intersections
+        for row in range(rows-1)
+    }
+    track: list[TrackPiece] = []
+    for i, (x,y) in enumerate(cells):
+        previous = cells[i-1]
+        following = cells[(i+1) % len(cells)]
+        entry = _DIRECTIONS.index((x-previous[0], y-previous[1]))
+        exit = _DIRECTIONS.index((following[0]-x, following[1]-y))
+        if entry != exit:
+            track.append(TrackPiece(17, TrackPieceType.CURVE, exit == (entry-1) % 4))
+        elif crossings.get((x,y), False):
+            track.append(TrackPiece(10, TrackPieceType.INTERSECTION, False))
+        else:
+            track.append(TrackPiece(36, TrackPieceType.STRAIGHT, False))
+    # The layout starts heading right from the first cell of the first row
+    track[0] = TrackPiece(34, TrackPieceType.FINISH, False)
+    track[1] = TrackPiece(33, TrackPieceType.START, False)
+    return track[1:] + track[:1]
+
+
+class StubVehicle:
+    """A stand-in for `anki.Vehicle` with the attributes read by the Ui"""
+    def __init__(self, id: int, track: list[TrackPiece], rng: random.Random) -> None:
+        self.id = id
+        self._track = track
+        self._rng = rng
+        self.map_position: int|None = rng.randrange(len(track))
+        self.road_offset: float|None = rng.uniform(-68, 68)
+        self.speed = rng.randint(300, 800)
+
+    @property
+    def current_track_piece(self) -> TrackPiece|None:
+        if self.map_position is None:
+            return None
+        return self._track[self.map_position]
+
+    def get_lane(self, mode):
+        if self.road_offset is None:
+            return None
+        return mode.get_closest_lane(self.road_offset)
+
+    def drive(self):
+        # Moves to the next piece and drifts sideways, so every frame has changes
+        self.map_position = (self.map_position + 1) % len(self._track)
+        self.road_offset = max(-68, min(68, self.road_offset + self._rng.uniform(-10, 10)))
+
+
+def _measure(
+        run: Callable[[], Any],
+        repeat: int,
+        before: Callable[[], Any]|None = None
+    ) -> dict[str, float]:
+    # Times `run` (in milliseconds), then reruns it once to trace its peak allocations
+    timings = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - start)*1000)
+    if before is not None:
+        before()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "min_ms": min(timings),
+        "median_ms": statistics.median(timings),
+        "mean_ms": statistics.fmean(timings),
+        "max_ms": max(timings),
+        "peak_python_bytes": peak
+    }
+
+
+async def bench_case(pieces: int, vehicles: int, repeat: int, seed: int) -> dict[str, Any]:
+    track = synthetic_track(pieces)
+    rng = random.Random(seed)
+    fleet = [StubVehicle(i, track, rng) for i in range(vehicles)]
+
+    result: dict[str, Any] = {"pieces": len(track), "vehicles": vehicles, "stages": {}}
+    stages = result["stages"]
+    vismap, tracker = generate(track)
+    stages["generate"] = _measure(lambda: generate(track), repeat)
+    stages["flip_h"] = _measure(lambda: flip_h(vismap, tracker), repeat)
+
+    # Without a window the Ui thread stops after setting up,
+    # so it doesn't compete with the measurements
+    ui = Ui(fleet, track, showUi=False, fps=1000)
+    await ui.waitForSetupAsync()
+    await ui.waitForFinishAsync()
+    result["map_size"] = ui.getMapsurf().get_size()
+
+    drive = lambda: [vehicle.drive() for vehicle in fleet]
+    # The drawing stages read the vehicles from the snapshot of the frame
+    driveAndCapture = lambda: (drive(), ui._takeSnapshot())
+    overlay = pygame.Surface(ui.getMapsurf().get_size(), pygame.SRCALPHA)
+    clear = lambda: (driveAndCapture(), overlay.fill((0, 0, 0, 0)))
+    frame = pygame.Surface(ui.UiSurf.get_size())
+    stages["genMapSurface"] = _measure(lambda: ui.genMapSurface(ui._compactMap), repeat)
+    stages["snapshot"] = _measure(ui._takeSnapshot, repeat, drive)
+    stages["carInfo"] = _measure(
+        lambda: [ui.carInfo(vehicle, i) for i, vehicle in enumerate(fleet)],
+        repeat, driveAndCapture
+    )
+    stages["carOnMap"] = _measure(lambda: ui.carOnMap(overlay), repeat, clear)
+    stages["carOnStreet"] = _measure(lambda: ui.carOnStreet(overlay), repeat, clear)
+    stages["updateUi"] = _measure(lambda: ui.updateUi(0, frame), repeat, drive)
+    return result
+
+
+def _peak_rss() -> int|None:
+    # The peak resident memory of this process in bytes
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak*1024
+
+
+def _commit() -> str|None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old: dict[str, Any], new: dict[str, Any]) -> list[str]:
+    """Lists the median time of every stage of `new` relative to `old`"""
+    lines = []
+    previous = {(case["pieces"], case["vehicles"]): case for case in old["cases"]}
+    for case in new["cases"]:
+        before = previous.get((case["pieces"], case["vehicles"]))
+        if before is None:
+            continue
+        for stage in STAGES:
+            if stage not in before["stages"]:
+                # The stage was added after the earlier run
+                continue
+            old_ms = before["stages"][stage]["median_ms"]
+            new_ms = case["stages"][stage]["median_ms"]
+            lines.append(
+                f"{case['pieces']:>6} pieces {case['vehicles']:>4} vehicles "
+                f"{stage:<14}{old_ms:>10.3f} ms ->{new_ms:>10.3f} ms "
+                f"({new_ms/old_ms if old_ms else float('inf'):.2f}x)"
+            )
+    return lines
+
+
+async def main(args: argparse.Namespace):
+    results: dict[str, Any] = {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "seed": args.seed,
+        "cases": []
+    }
+    for pieces in args.pieces:
+        for vehicles in args.vehicles:
+            case = await bench_case(pieces, vehicles, args.repeat, args.seed)
+            results["cases"].append(case)
+            print(
+                f"{case['pieces']:>6} pieces {vehicles:>4} vehicles: " + ", ".join(
+                    f"{stage} {case['stages'][stage]['median_ms']:.2f} ms" for stage in STAGES
+                ),
+                file=sys.stderr
+            )
+    results["peak_rss_bytes"] = _peak_rss()
+
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as file:
+            file.write(output)
+    if args.compare is not None:
+        with open(args.compare) as file:
+            print("\n".join(compare(json.load(file), results)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pieces", type=int, nargs="+", default=[16, 128, 1024],
+        help="approximate track sizes to benchmark")
+    parser.add_argument("--vehicles", type=int, nargs="+", default=[1, 20, 200],
+        help="vehicle counts to benchmark")
+    parser.add_argument("--repeat", type=int, default=10, help="measurements per stage")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the vehicle positions")
+    parser.add_argument("--output", help="file to write the JSON results to (default: stdout)")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    warnings.simplefilter("ignore")
+    asyncio.run(main(parser.parse_args()))
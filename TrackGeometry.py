@@ -0,0 +1,263 @@
+import math
+import time
+from array import array
+from typing import Iterable
+
+from anki import TrackPieceType
+
+try:
+    from .VisMapGenerator import CompactVismap, PIECE_TYPES
+except ImportError:
+    from VisMapGenerator import CompactVismap, PIECE_TYPES
+from VehicleSnapshot import VehicleSnapshot
+
+TILE_SIZE = 100
+LANE_SCALE = (20 - 5)/60
+"""Pixels a vehicle moves sideways per millimetre of road offset"""
+
+PIECE_LENGTHS: dict[TrackPieceType, float] = {
+    TrackPieceType.STRAIGHT: 560,
+    TrackPieceType.CURVE: 440,
+    TrackPieceType.INTERSECTION: 560,
+    TrackPieceType.START: 340,
+    TrackPieceType.FINISH: 220,
+    TrackPieceType.LAUNCH_START: 560
+}
+"""The approximate length (in mm) of the center line of each piece type"""
+
+_CORNER_DIRECTIONS: dict[int, tuple[int, int]] = {
+    0: (1, 0),
+    90: (0, 0),
+    180: (0, 1),
+    270: (1, 1)
+}
+"""The corner of a cell a curve with a given rotation bends around"""
+
+
+def _wrap(angle: float) -> float:
+    # Wraps an angle in radians into [-pi, pi)
+    return (angle + math.pi) % math.tau - math.pi
+
+
+class PathTable:
+    """
+    The screen geometry of every map position.
+
+    The table is built once from a compact vismap.
+    Every map position stores the endpoints of its center line,
+    the sprite anchor at the middle of the piece, the lane normal
+    and the sprite angle, so placing a vehicle only takes a lookup
+    and a multiply-add on its road offset.
+
+    Positions along a piece are given as a parameter `t`
+    going from 0 (entering the piece) to 1 (leaving it).
+    """
+    def __init__(self, vismap: CompactVismap) -> None:
+        self.startX = array("d")
+        self.startY = array("d")
+        self.endX = array("d")
+        self.endY = array("d")
+        self.anchorX = array("d")
+        self.anchorY = array("d")
+        self.normalX = array("d")
+        self.normalY = array("d")
+        self.angle = array("d")
+        self.curve = array("b")
+        # Only used by curves: the corner, radial angles (radians) and lane scale of the arc
+        self.cornerX = array("d")
+        self.cornerY = array("d")
+        self.entryAngle = array("d")
+        self.sweep = array("d")
+        self.lane = array("d")
+        for e in vismap.position_element:
+            self._add(vismap, e)
+
+    def __len__(self) -> int:
+        return len(self.angle)
+
+    def extend(self, vismap: CompactVismap, positions: Iterable[int]):
+        """Adds the geometry of further map positions, which follow the ones in the table"""
+        for position in positions:
+            self._add(vismap, vismap.position_element[position])
+
+    def _add(self, vismap: CompactVismap, e: int):
+        x, y = vismap.x[e], vismap.y[e]
+        orientation = CompactVismap.ORIENTATIONS[vismap.orientation[e]]
+        rotation = vismap.rotation[e]
+        centerX = x*TILE_SIZE + TILE_SIZE/2
+        centerY = y*TILE_SIZE + TILE_SIZE/2
+        if PIECE_TYPES[vismap.piece_type[e]] is not TrackPieceType.CURVE:
+            self.startX.append(centerX - orientation[0]*TILE_SIZE/2)
+            self.startY.append(centerY - orientation[1]*TILE_SIZE/2)
+            self.endX.append(centerX + orientation[0]*TILE_SIZE/2)
+            self.endY.append(centerY + orientation[1]*TILE_SIZE/2)
+            self.anchorX.append(centerX)
+            self.anchorY.append(centerY)
+            self.normalX.append(-orientation[1]*LANE_SCALE)
+            self.normalY.append(orientation[0]*LANE_SCALE)
+            self.angle.append(math.degrees(math.atan2(-orientation[1], orientation[0])) - 90)
+            self.curve.append(0)
+            self.cornerX.append(0)
+            self.cornerY.append(0)
+            self.entryAngle.append(0)
+            self.sweep.append(0)
+            self.lane.append(0)
+            return
+
+        direction = _CORNER_DIRECTIONS[rotation]
+        cornerX = x*TILE_SIZE + TILE_SIZE*direction[0]
+        cornerY = y*TILE_SIZE + TILE_SIZE*direction[1]
+        radians = math.radians(rotation)
+        middleAngle = math.atan2(math.sin(math.pi/4+radians), -math.cos(math.pi/4+radians))
+        # The curve leaves through the edge its orientation points at
+        exitAngle = math.atan2(
+            centerY + orientation[1]*TILE_SIZE/2 - cornerY,
+            centerX + orientation[0]*TILE_SIZE/2 - cornerX
+        )
+        sweep = 2*_wrap(exitAngle - middleAngle)
+        entryAngle = middleAngle - sweep/2
+        # The turning direction on screen, which is mirrored on flipped maps
+        clockwise = sweep > 0
+        # The road offset points the other way round on clockwise curves
+        lane = (-1 if clockwise else 1)*LANE_SCALE
+        radius = TILE_SIZE/2
+
+        self.startX.append(cornerX + radius*math.cos(entryAngle))
+        self.startY.append(cornerY + radius*math.sin(entryAngle))
+        self.endX.append(cornerX + radius*math.cos(entryAngle + sweep))
+        self.endY.append(cornerY + radius*math.sin(entryAngle + sweep))
+        self.anchorX.append(cornerX + radius*math.cos(middleAngle))
+        self.anchorY.append(cornerY + radius*math.sin(middleAngle))
+        self.normalX.append(lane*math.cos(middleAngle))
+        self.normalY.append(lane*math.sin(middleAngle))
+        self.angle.append(
+            rotation - 135 + (180 if clockwise else 0)
+        )
+        self.curve.append(1)
+        self.cornerX.append(cornerX)
+        self.cornerY.append(cornerY)
+        self.entryAngle.append(entryAngle)
+        self.sweep.append(sweep)
+        self.lane.append(lane)
+
+    def place(self, position: int, offset: float, t: float = 0.5) -> tuple[float, float, float]:
+        """
+        Returns the screen position of a vehicle's center and its sprite angle.
+
+        :param position: The map position of the vehicle
+        :param offset: The road offset of the vehicle in millimetres
+        :param t: How far along the piece the vehicle is (0 to 1)
+        """
+        if t == 0.5:
+            return (
+                self.anchorX[position] + self.normalX[position]*offset,
+                self.anchorY[position] + self.normalY[position]*offset,
+                self.angle[position]
+            )
+        if not self.curve[position]:
+            return (
+                self.startX[position] + (self.endX[position]-self.startX[position])*t
+                    + self.normalX[position]*offset,
+                self.startY[position] + (self.endY[position]-self.startY[position])*t
+                    + self.normalY[position]*offset,
+                self.angle[position]
+            )
+        sweep = self.sweep[position]
+        radial = self.entryAngle[position] + sweep*t
+        radius = TILE_SIZE/2 + self.lane[position]*offset
+        return (
+            self.cornerX[position] + radius*math.cos(radial),
+            self.cornerY[position] + radius*math.sin(radial),
+            self.angle[position] - math.degrees(sweep*(t-0.5))
+        )
+
+    def placeAll(
+            self,
+            positions: Iterable[int],
+            offsets: Iterable[float],
+            ts: Iterable[float]|None = None
+        ) -> list[tuple[float, float, float]]:
+        """Places many vehicles at once. See `PathTable.place`"""
+        if ts is None:
+            anchorX, anchorY = self.anchorX, self.anchorY
+            normalX, normalY = self.normalX, self.normalY
+            angle = self.angle
+            return [
+                (
+                    anchorX[position] + normalX[position]*offset,
+                    anchorY[position] + normalY[position]*offset,
+                    angle[position]
+                )
+                for position, offset in zip(positions, offsets)
+            ]
+        return [
+            self.place(position, offset, t)
+            for position, offset, t in zip(positions, offsets, ts)
+        ]
+
+
+class MotionModel:
+    """
+    Dead reckoning of vehicles between track piece changes.
+
+    Vehicles only report when they enter a new piece.
+    From then on, their progress along the piece (see `PathTable.place`)
+    is extrapolated from their speed and the time since they entered it,
+    until they reach its end or the next piece change arrives.
+    Pieces are entered when the vehicle reported it (see `MotionModel.notify`),
+    or at the first frame they were seen on for vehicles that don't report.
+    Vehicles that weren't seen entering their piece are placed at its middle.
+    """
+    def __init__(self) -> None:
+        self._entered: list[tuple[int, float|None]] = []
+        """The map position (-1 if unaligned) of each vehicle and when it was entered"""
+        self._notified: dict[int, float] = {}
+        """When each vehicle (by id) last reported a piece change"""
+        self._lastFrame = -math.inf
+
+    def notify(self, vehicleId: int, now: float|None = None):
+        """
+        Records that a vehicle reported entering a new piece.
+
+        :param now: When it was reported (from `time.perf_counter`), by default now
+        """
+        self._notified[vehicleId] = time.perf_counter() if now is None else now
+
+    def progress(self, snapshot: VehicleSnapshot, now: float|None = None) -> list[float]:
+        """
+        Returns how far along their pieces the vehicles are (from 0 to 1).
+
+        :param now: The current time (from `time.perf_counter`),
+            by default when the snapshot was captured
+        """
+        if now is None:
+            now = snapshot.time
+        positions = snapshot.positions
+        if len(self._entered) != len(positions):
+            # Vehicles were added or removed
+            self._entered = [(position, None) for position in positions]
+        progress = []
+        lastFrame, self._lastFrame = self._lastFrame, now
+        for i, position in enumerate(positions):
+            entered, since = self._entered[i]
+            notified = self._notified.get(snapshot.ids[i], -math.inf)
+            # Only reports since the last frame belong to a piece change seen now
+            reported = lastFrame < notified <= now
+            if position != entered:
+                # Newly aligned vehicles might be anywhere on their piece
+                if entered < 0:
+                    since = None
+                else:
+                    since = notified if reported else now
+                self._entered[i] = (position, since)
+            elif reported and since is not None and since < notified:
+                # The frame before saw the new piece before its report was handled
+                since = notified
+                self._entered[i] = (position, since)
+            pieceType = snapshot.getPieceType(i)
+            if since is None or pieceType is None:
+                progress.append(0.5)
+                continue
+            distance = (snapshot.getSpeed(i) or 0)*(now-since)
+            progress.append(min(distance/PIECE_LENGTHS.get(pieceType, 560), 1.))
+        return progress
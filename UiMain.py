@@ -1,6 +1,12 @@
+import os
 import itertools
-import math
-from typing import Iterable
+import bisect
+import collections
+import contextlib
+import inspect
+import time
+import logging
+from typing import BinaryIO, Callable, Iterable, Iterator
 import warnings
 import threading
 import concurrent.futures
@@ -13,14 +19,49 @@ from anki.misc.lanes import BaseLane
 
 from Design import Design
 from VehicleControlWindow import vehicleControler
-from helpers import *
+from FleetCommands import FleetCommands
+from CommandLatency import LatencyHistogram
+from Compositor import Compositor
+from FramePacer import FramePacer, PacingStats
+from EventConsole import EventConsole, EventStats
+from FrameProfiler import FrameProfiler, FrameStats, FRAME_STAGES
+from Assets import TextCache, VehicleSprites, getImage, getTileAtlas
 
 try:
-    from .VisMapGenerator import generate, flip_h, Vismap, Element
+    from .VisMapGenerator import VismapBuilder, Vismap, CompactVismap, PIECE_TYPES, flip_element_h
 except ImportError:
-    from VisMapGenerator import generate, flip_h, Vismap
+    from VisMapGenerator import VismapBuilder, Vismap, CompactVismap, PIECE_TYPES, flip_element_h
+from TrackGeometry import PathTable, MotionModel
+from VehicleSnapshot import VehicleSnapshot
+from TelemetryLog import TelemetryRecorder
+from LayoutCache import LayoutCache
 
 CAR_INFO_WIDTH = 500
+_WAKE_EVENT = pygame.event.custom_type()
+CAR_INFO_SCROLL_STEP = 20
+"""Pixels the car info column scrolls per mouse wheel step"""
+HUD_WIDTH = 280
+HUD_REFRESH_RATE = 4
+"""How often (per second) the performance HUD is redrawn"""
+HUD_SPARKLINE_FRAMES = 120
+HUD_SPARKLINE_HEIGHT = 40
+
+def _mapSize(visMap: Vismap|CompactVismap) -> tuple[int, int]:
+    if isinstance(visMap, CompactVismap):
+        return visMap.width, visMap.height
+    return len(visMap), len(visMap[0])
+
+def _buildLaneSystem(customLanes: list[BaseLane]) -> tuple[list[BaseLane], type[BaseLane]]:
+    # All known lanes and a lane system made of them
+    lanes = customLanes + anki.Lane3.getAll() + anki.Lane4.getAll()
+    laneSystem: type[BaseLane] = BaseLane( # type: ignore
+        "CustomLanes",
+        {
+            lane.name : lane.value 
+            for lane in lanes
+        }
+    )
+    return lanes, laneSystem
 
 class Ui:    
     def __init__(self,
@@ -33,7 +74,15 @@ class Ui:
             fps: int = 10,
             customLanes: list[BaseLane] = [], 
             design: Design = Design(),
-            vehicleColors: Iterable[tuple[int, int, int]] = []
+            vehicleColors: Iterable[tuple[int, int, int]] = [],
+            layoutCache: LayoutCache|str|None = None,
+            headless: bool = False,
+            eventDriven: bool = False,
+            heartbeat: float = 1.0,
+            adaptiveFps: bool = False,
+            minFps: float = 2,
+            frameBudget: float = 0.5,
+            deadReckoning: bool = False
         ) -> None:
         self._vehicleColorIterator = itertools.chain(
             iter(vehicleColors), 
@@ -45,14 +94,11 @@ class Ui:
             next(self._vehicleColorIterator)
             for _ in range(len(vehicles))
         ]
-        self._customLanes = customLanes + anki.Lane3.getAll() + anki.Lane4.getAll()
-        self._laneSystem: type[BaseLane] = BaseLane( # type: ignore
-            "CustomLanes",
-            {
-                lane.name : lane.value 
-                for lane in self._customLanes
-            }
-        )
+        self._customLanes, self._laneSystem = _buildLaneSystem(customLanes)
+        # The vehicles are read once per frame, every drawing stage uses this snapshot
+        self._snapshot = VehicleSnapshot(self._laneSystem)
+        self._progress: list[float] = []
+        self._recorder: TelemetryRecorder|None = None
         #setting up map
         flip_horizontal = flip[0]
         if flip[1]:
@@ -61,21 +107,57 @@ class Ui:
             orientation = (-orientation[0], -orientation[1])
 
         self._map = map
-        self._visMap, self._lookup = generate(self._map, orientation)
+        self._orientation = orientation
+        self._flipHorizontal = flip_horizontal
+        self._mapBuilder: VismapBuilder|None = None
+        # Pieces added while the Ui is running are applied by the render thread
+        self._mapChanges: collections.deque[tuple[str, object]] = collections.deque()
+        self._mapTiles: pygame.Surface|None = None
         
-        if flip_horizontal:
-            self._visMap, self._lookup = flip_h(self._visMap, self._lookup)
+        if isinstance(layoutCache, str):
+            layoutCache = LayoutCache(layoutCache)
+        self._layoutCache = layoutCache
+        self._layoutKey: str|None = None
+        compactMap = None
+        if self._layoutCache is not None:
+            self._layoutKey = LayoutCache.layoutKey(self._map, orientation, flip_horizontal)
+            compactMap = self._layoutCache.loadLayout(self._layoutKey, self._map)
+        if compactMap is None:
+            self._buildMap()
+            if self._layoutCache is not None:
+                self._layoutCache.storeLayout(self._layoutKey, self._compactMap)
+        else:
+            self._setCompactMap(compactMap)
 
         
         #loading aditional information
-        self.showUi = showUi
+        # Headless Ui's keep rendering frames without opening a window
+        self._headless = headless
+        self.showUi = showUi and not headless
         self.fps = fps
+        # Event driven Ui's only draw when notified of changes (at most at fps)
+        # and every heartbeat seconds otherwise
+        self._eventDriven = eventDriven
+        self.heartbeat = heartbeat
+        self._wakePending = False
+        # Adaptive Ui's draw at up to fps while vehicles move and at minFps while they stand.
+        # Drawing may only take up frameBudget of the time
+        self._pacer = FramePacer(fps, minFps, frameBudget) if adaptiveFps else None
+        # Moves vehicles along their pieces between piece changes
+        self._motion = MotionModel() if deadReckoning else None
+        # The piece change watchers telling the motion model when vehicles entered their pieces
+        self._motionWatchers: dict[int, Callable[[], None]] = {}
         self._design = design
         
         #starting pygame
+        if headless:
+            os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
         pygame.init()
         self._font = pygame.font.SysFont(design.Font, design.FontSize)
+        self._hudFont = pygame.font.SysFont(design.Font, max(design.FontSize*2//3, 10))
         # integrated event logging
+        # Events are queued by addEvent and drawn by the render thread
+        self._console = EventConsole()
         self._eventSurf: pygame.Surface
         #Ui surfaces
         self.UiSurf: pygame.Surface
@@ -83,31 +165,69 @@ class Ui:
         self._ControlButtonSurf: pygame.Surface
         self._ScrollSurf: pygame.Surface
         self._rects: tuple[pygame.Rect, pygame.Rect, pygame.Rect]
-        #starting ui
-        self._thread = threading.Thread(target=self.__eventWrapper,daemon=True)
-        self._run = True
-        self._thread.start()
+        self._consoleRect: pygame.Rect
+        self._overlaySurf: pygame.Surface
+        #vehicle sprites
+        self._carIMG = getImage("vehicle.png")
+        self._carSprites = VehicleSprites(self._carIMG)
+        for color in self._accumulatedVehicleColors:
+            self._carSprites.add(color)
+        for vehicle in self._vehicles:
+            self._watchVehicle(vehicle)
+        #rendered text and car info cards
+        self._textCache = TextCache()
+        self._carInfoCards: dict[int, tuple[tuple, pygame.Surface]] = {}
+        #which vehicles are on which cell of the map
+        self._occupancy: dict[tuple[int, int], list[int]] = {}
+        self._vehicleCells: list[tuple[int|None, tuple[int, int]|None]] = []
+        self._occupancyChanges: set[tuple[int, int]] = set()
+        self._labelRects: dict[tuple[int, int], pygame.Rect] = {}
+        #cached layers of the Ui
+        self._compositor: Compositor
+        self._renderLock = threading.Lock()
+        # How long the stages of recent frames took
+        self._profiler = FrameProfiler()
+        self._hudVisible = design.ShowPerformanceHud
+        # Scroll position of the car info column in pixels
+        self._carInfoScroll = 0
+        # Damage that wasn't shown yet (getUiSurf may compose from other threads)
+        self._damage: list[pygame.Rect] = []
+        #double buffered frames of headless Ui's
+        self._frames: list[pygame.Surface] = []
+        self._frontFrame = 0
+        self._frameSequence = 0
+        self._frameLock = threading.Lock()
+        self._lastFrameDamage: list[pygame.Rect] = []
         # concurrent.futures doesn not see the potential of manually created futures
         # too bad!
+        # (They have to exist before the ui thread starts using them)
         self._uiSetupComplete = concurrent.futures.Future()
         self._endFuture = concurrent.futures.Future()
+        #starting ui
+        self._thread = threading.Thread(target=self.__eventWrapper,daemon=True)
+        self._run = True
+        self._thread.start()
         #getting eventloop and starting ControlWindow
         self._eventLoop = asyncio.get_running_loop()
+        # Sends commands to many vehicles at once
+        self.fleet = FleetCommands(self._vehicles, self._eventLoop)
         self._controlThread = None
         if showController:
             self.startVehicleControlUI()
-        
-        self._carIMG = load_image("vehicle.png")
     
     @classmethod
     def fromController(cls,
         controller: anki.Controller,
+        *,
+        renderProcess: bool = False,
         **kwargs
     ):
+        if renderProcess:
+            return createUi(list(controller.vehicles), controller.map, renderProcess=True, **kwargs)
         return cls(list(controller.vehicles), controller.map, **kwargs)
     
     #generating vismap
-    def genGrid(self, visMap, mapsurf) -> pygame.Surface:
+    def genGrid(self, visMap: Vismap|CompactVismap, mapsurf) -> pygame.Surface:
         drawGridLine = lambda start, end: pygame.draw.line(
             mapsurf,
             self._design.Line,
@@ -115,178 +235,328 @@ class Ui:
             end,
             self._design.LineWidth
         )
-        for x in range(1,len(visMap)):
-            drawGridLine((x*100, 0), (x*100, len(visMap[x])*100))
-        for y in range(1,len(visMap[0])):
-            drawGridLine((0, y*100), (len(visMap)*100, y*100))
+        width, height = _mapSize(visMap)
+        for x in range(1,width):
+            drawGridLine((x*100, 0), (x*100, height*100))
+        for y in range(1,height):
+            drawGridLine((0, y*100), (width*100, y*100))
         return mapsurf
-    def genMapSurface(self, visMap: Vismap):
-        imStraight = load_image("straight.png")
-        imCurve = load_image("curve.png")
-        imIntersection = load_image("intersection.png")
-        imStart = load_image("start.png")
-        mapSurf = pygame.surface.Surface((len(visMap)*100, len(visMap[0])*100),pygame.SRCALPHA)
-        for (i, y, x), current in enumerated_flatten(visMap):
-            current: Element
-            match current.piece.type:
-                case TrackPieceType.STRAIGHT:
-                    imStraight.set_alpha(int((1.5**-i)*255))
-                    mapSurf.blit(
-                        rotateSurf(imStraight,current.orientation,90),
-                        (x*100,y*100)
-                    )
-                    # mapSurf.blit(self._font.render(f"{current.orientation}",True,(100,100,100)),(x*100,y*100))
+    def _drawTiles(
+            self,
+            visMap: CompactVismap,
+            mapSurf: pygame.Surface,
+            cells: Iterable[tuple[int, int]]|None = None
+        ):
+        # Draws the track pieces of the given cells (or all of them) onto mapSurf
+        atlas = getTileAtlas()
+        if cells is None:
+            elements = range(len(visMap))
+        else:
+            elements = []
+            for x, y in cells:
+                mapSurf.fill((0, 0, 0, 0), (x*100, y*100, 100, 100))
+                elements.extend(visMap.cell(x, y))
+        tiles = []
+        for e in elements:
+            x, y, i = visMap.x[e], visMap.y[e], visMap.layer[e]
+            pieceType = PIECE_TYPES[visMap.piece_type[e]]
+            match pieceType:
+                case TrackPieceType.STRAIGHT | TrackPieceType.START:
+                    # Equivalent to rotateSurf(image, orientation, 90)
+                    tiles.append((
+                        atlas.get(pieceType, visMap.orientation[e]*90 + 90, i),
+                        (x*100, y*100)
+                    ))
                 case TrackPieceType.CURVE:
-                    imCurve.set_alpha(int((1.5**-i)*255))
-                    mapSurf.blit(pygame.transform.rotate(imCurve, float(current.rotation)), (x*100, y*100)) 
-                    #mapSurf.blit(self._font.render(
-                    #    f"{current.rotation} {current.orientation} {int(current.flipped) if current.flipped is not None else '/'}",
-                    #    True,
-                    #    (100,100,100)
-                    #),(x*100,y*100))
+                    tiles.append((atlas.get(pieceType, visMap.rotation[e], i), (x*100, y*100)))
                 case TrackPieceType.INTERSECTION:
-                    if current.orientation[0] != 0:
-                        imIntersection.set_alpha(int((1.5**-i)*255))
-                        mapSurf.blit(imIntersection, (x*100,y*100))
-                case TrackPieceType.START:
-                    imStart.set_alpha(int((1.5**-i)*255))
-                    mapSurf.blit(rotateSurf(imStart,current.orientation,90),(x*100,y*100))
-                    # mapSurf.blit(self._font.render(f"{current.orientation}",True,(100,100,100)),(x*100,y*100))
+                    if CompactVismap.ORIENTATIONS[visMap.orientation[e]][0] != 0:
+                        tiles.append((atlas.get(pieceType, 0, i), (x*100, y*100)))
                 case TrackPieceType.FINISH:
                     pass
-        self._visMapSurf = mapSurf
+        mapSurf.blits(tiles, doreturn=False)
+    def _decorateMap(self, visMap: CompactVismap, cells: Iterable[tuple[int, int]]|None = None):
+        # Adds grid and outline to the drawn tiles of the given cells (or all of them)
+        if cells is None:
+            self._visMapSurf = self._mapTiles.copy()
+            self._decorate(visMap)
+            return
+        for x, y in cells:
+            rect = pygame.Rect(x*100, y*100, 100, 100)
+            self._visMapSurf.set_clip(rect)
+            # Filling first and taking the maximum copies the tiles exactly, alpha included
+            self._visMapSurf.fill((0, 0, 0, 0), rect)
+            self._visMapSurf.blit(self._mapTiles, rect, rect, pygame.BLEND_RGBA_MAX)
+            self._decorate(visMap)
+        self._visMapSurf.set_clip(None)
+    def _decorate(self, visMap: CompactVismap):
         if self._design.ShowGrid:
-            self._visMapSurf = self.genGrid(visMap,mapSurf)
+            self._visMapSurf = self.genGrid(visMap,self._visMapSurf)
         if self._design.ShowOutlines:
             pygame.draw.rect(
                 self._visMapSurf,
                 self._design.Line,
-                (0, 0, len(visMap)*100, len(visMap[0])*100),
+                (0, 0, visMap.width*100, visMap.height*100),
                 self._design.LineWidth
             )
+    def genMapSurface(self, visMap: Vismap|CompactVismap):
+        if not isinstance(visMap, CompactVismap):
+            visMap = CompactVismap.from_nested(visMap)
+        self._mapTiles = pygame.surface.Surface((visMap.width*100, visMap.height*100),pygame.SRCALPHA)
+        self._drawTiles(visMap, self._mapTiles)
+        self._decorateMap(visMap)
+    
+    def _loadMapSurface(self):
+        # Uses the pre-rendered map surface from the layout cache when possible
+        if self._layoutCache is None or self._layoutKey is None:
+            self.genMapSurface(self._compactMap)
+            return
+        key = LayoutCache.surfaceKey(self._layoutKey, self._design)
+        mapSurf = self._layoutCache.loadSurface(key)
+        if mapSurf is None:
+            self.genMapSurface(self._compactMap)
+            self._layoutCache.storeSurface(key, self._visMapSurf)
+        else:
+            self._visMapSurf = mapSurf
+            self._mapTiles = None
+    
+    #incremental map changes
+    def _getMapBuilder(self) -> VismapBuilder:
+        # The builder is only created when needed, layouts from the cache don't need it
+        if self._mapBuilder is None:
+            self._mapBuilder = VismapBuilder(self._orientation)
+            self._mapBuilder.extend(self._map)
+        return self._mapBuilder
+    def _setCompactMap(self, compactMap: CompactVismap):
+        self._compactMap = compactMap
+        self._paths = PathTable(self._compactMap)
+    def _buildMap(self):
+        compactMap = CompactVismap.from_nested(*self._getMapBuilder().build())
+        if self._flipHorizontal:
+            compactMap = compactMap.flip_h()
+        self._setCompactMap(compactMap)
+    def _extendCompactMap(self, start: int):
+        # Adds the pieces from map position start on, the bounds of the map must not have changed
+        builder = self._mapBuilder
+        for position in range(start, len(builder.pieces)):
+            x, y, layer = builder.positions[position]
+            element = builder.cells[(x, y)][layer]
+            if self._flipHorizontal:
+                element = flip_element_h(element)
+            self._compactMap.insert(*self._screenCell((x, y)), position, element)
+        self._paths.extend(self._compactMap, range(start, len(builder.pieces)))
+    def _screenCell(self, cell: tuple[int, int]) -> tuple[int, int]:
+        # Converts an unnormalized cell of the map builder into a cell of the vismap
+        minX, minY, _, _ = self._mapBuilder.bounds
+        x, y = cell[0]-minX, cell[1]-minY
+        if self._flipHorizontal:
+            x = self._mapBuilder.size[0]-1-x
+        return x, y
+    def _applyMapChanges(self):
+        if not self._mapChanges:
+            return
+        self._getMapBuilder()
+        oldOrigin = self._screenCell((0, 0))
+        oldSize = self._mapBuilder.size
+        oldBounds = self._mapBuilder.bounds
+        firstNew = len(self._mapBuilder.pieces)
+        changed: set[tuple[int, int]] = set()
+        # Tiles of a cached map surface aren't available for partial redraws
+        rebuild = self._mapTiles is None
+        replaced = False
+        while self._mapChanges:
+            kind, value = self._mapChanges.popleft()
+            if kind == "append":
+                changed.add(self._mapBuilder.append(value))
+                continue
+            known = [(p.loc, p.type, p.clockwise) for p in self._mapBuilder.pieces]
+            pieces = list(value)
+            if [(p.loc, p.type, p.clockwise) for p in pieces[:len(known)]] == known:
+                # The new map extends the current one
+                for piece in pieces[len(known):]:
+                    changed.add(self._mapBuilder.append(piece))
+            else:
+                self._mapBuilder = VismapBuilder(self._orientation)
+                self._mapBuilder.extend(pieces)
+                rebuild = replaced = True
+        self._map = self._mapBuilder.pieces
+        # Layouts changed at runtime are not cached
+        self._layoutKey = None
+        if replaced or self._mapBuilder.bounds != oldBounds:
+            self._buildMap()
+        else:
+            # The cells keep their place, so only the new pieces are laid out
+            self._extendCompactMap(firstNew)
+        self._resetOccupancy()
+        
+        if rebuild:
+            self.genMapSurface(self._compactMap)
+        else:
+            # Tiles that were already drawn are reused, only the new ones are drawn
+            origin = self._screenCell((0, 0))
+            resized = self._mapBuilder.size != oldSize or origin != oldOrigin
+            if resized:
+                oldTiles = self._mapTiles
+                self._mapTiles = pygame.surface.Surface(
+                    (self._compactMap.width*100, self._compactMap.height*100),
+                    pygame.SRCALPHA
+                )
+                self._mapTiles.blit(
+                    oldTiles,
+                    ((origin[0]-oldOrigin[0])*100, (origin[1]-oldOrigin[1])*100)
+                )
+            cells = [self._screenCell(cell) for cell in changed]
+            self._drawTiles(self._compactMap, self._mapTiles, cells)
+            self._decorateMap(self._compactMap, None if resized else cells)
+        
+        if self._visMapSurf.get_size() != self._overlaySurf.get_size():
+            self._resizeUi()
+        else:
+            self._compositor.invalidate("map")
+            self._compositor.invalidate("carNumbers")
+            self._compositor.invalidate("vehicles")
     
     #infos for cars
     def _blitCarInfoOnSurface(self, surf: pygame.Surface, text: str, dest: tuple[int, int]):
         surf.blit(
-            self._font.render(text, True, self._design.Text),
+            self._textCache.render(self._font, text, self._design.Text),
             (
                 10+dest[0]*300,
                 10+dest[1]*self._design.FontSize
             )
         )
+    def _carInfoTexts(self, number: int, snapshot: VehicleSnapshot, row: int) -> tuple[str, ...]:
+        # The text of the card of vehicle number read from a row of snapshot,
+        # numbers are rounded like they are shown
+        return (
+            f"Vehicle ID: {snapshot.ids[row]}",
+            f"Number: {number}",
+            f"Position: {snapshot.getPosition(row)}",
+            f"Offset: {round(snapshot.getOffset(row),2)}",
+            f"Lane: {snapshot.getLane(row)}",
+            # Speeds are stored as floats, but vehicles report whole numbers
+            f"Speed: {round(snapshot.getSpeed(row),2):g}",
+            f"Trackpiece: {snapshot.getPieceType(row).name}"
+        )
+    def _carInfoKey(self, number: int, snapshot: VehicleSnapshot|None = None, row: int = 0) -> tuple:
+        # Everything shown on a car info card, by default as of the latest snapshot
+        if snapshot is None:
+            snapshot, row = self._snapshot, number
+        try:
+            return (self._carInfoTexts(number, snapshot, row), self._accumulatedVehicleColors[number])
+        except (AttributeError, TypeError) as e:
+            return (str(e),)
     def carInfo(self, vehicle: anki.Vehicle, number: int) -> pygame.Surface:
+        """
+        Renders the info card of vehicle, shown as vehicle `number`.
+        Cards are only re-rendered when the shown information changed,
+        so the returned surface is shared and must not be modified.
+        """
+        snapshot = VehicleSnapshot(self._snapshot.laneTable)
+        snapshot.capture([vehicle])
+        # The card cache is shared with the render thread
+        with self._renderLock:
+            return self._carInfoCard(number, snapshot)
+    def _carInfoCard(self, number: int, snapshot: VehicleSnapshot|None = None, row: int = 0) -> pygame.Surface:
+        key = self._carInfoKey(number, snapshot, row)
+        cached = self._carInfoCards.get(number)
+        if cached is not None and cached[0] == key:
+            return cached[1]
         surf = pygame.surface.Surface((CAR_INFO_WIDTH,20+self._design.FontSize*4))
         surf.fill(self._design.CarInfoFill)
-        try:
-            self._blitCarInfoOnSurface(surf, f"Vehicle ID: {vehicle.id}",(0,0))
-            self._blitCarInfoOnSurface(surf, f"Number: {number}",(1,0))
-            self._blitCarInfoOnSurface(surf, f"Position: {vehicle.map_position}",(0,1))
-            self._blitCarInfoOnSurface(surf, f"Offset: {round(vehicle.road_offset,2)}",(1,1))
-            self._blitCarInfoOnSurface(surf, f"Lane: {vehicle.get_lane(self._laneSystem)}",(0,2))
-            self._blitCarInfoOnSurface(surf, f"Speed: {round(vehicle.speed,2)}", (1,2))
-            self._blitCarInfoOnSurface(surf, f"Trackpiece: {vehicle.current_track_piece.type.name}",(0,3))
-            pygame.draw.circle(surf,self._accumulatedVehicleColors[number],
+        if len(key) == 2:
+            texts, color = key
+            for i, text in enumerate(texts):
+                self._blitCarInfoOnSurface(surf, text, (i%2, i//2))
+            pygame.draw.circle(surf,color,
                                (CAR_INFO_WIDTH-10-self._design.FontSize/2,10+self._design.FontSize*3.5),
                                self._design.FontSize/2)
-        except (AttributeError, TypeError) as e:
-            surf.fill(self._design.CarInfoFill)
+        else:
             self._blitCarInfoOnSurface(surf, f"Invalid information:", (0,0))
-            self._blitCarInfoOnSurface(surf, f"{e}", (0,1))
-            warnings.warn(str(e))
+            self._blitCarInfoOnSurface(surf, key[0], (0,1))
+            warnings.warn(key[0])
         if self._design.ShowOutlines:
             pygame.draw.rect(surf,self._design.Line,surf.get_rect(),self._design.LineWidth)
+        self._carInfoCards[number] = (key, surf)
         return surf
-    def carOnMap(self) ->pygame.Surface:
-        mapping = [
-            [
-                []
-                for _ in range(len(column))
-            ]
-            for column in self._visMap
-        ]
-        
-        surf = pygame.surface.Surface(self._visMapSurf.get_size(),pygame.SRCALPHA)
-        for i, vehicle in enumerate(self._vehicles):
-            if vehicle.map_position is None:
-                # Disregard unaligned vehicles
+    #vehicle numbers on the map
+    def _positionCell(self, position: int|None) -> tuple[int, int]|None:
+        if position is None or position >= len(self._paths):
+            # Disregard unaligned vehicles and those outside of the known map
+            return None
+        e = self._compactMap.position_element[position]
+        return self._compactMap.x[e], self._compactMap.y[e]
+    def _resetOccupancy(self):
+        # Forgets where the vehicles are, so the next update places all of them again
+        self._occupancyChanges.update(self._occupancy)
+        self._occupancy = {}
+        self._vehicleCells = [(None, None)]*len(self._snapshot)
+    def _updateOccupancy(self):
+        # Moves the vehicles whose map position changed to their new cells
+        positions = self._snapshot.positions
+        if len(self._vehicleCells) != len(positions):
+            # Vehicle numbers shift when vehicles are added or removed
+            self._resetOccupancy()
+        for i, position in enumerate(positions):
+            position = None if position < 0 else position
+            known, oldCell = self._vehicleCells[i]
+            if position == known:
                 continue
-            x, y, _ = self._lookup[vehicle.map_position]
-            mapping[x][y].append(i)
-        
-        for x, column in enumerate(mapping):
-            for y, layers in enumerate(column):
-                width = 0
-                for i, current in enumerate(layers):
-                    text = self._font.render(
-                        f"{current}",
-                        True,
-                        self._design.CarPosText
-                    )
-                    width += text.get_width()
-                    surf.blit(
-                        text,
-                        (x*100+100-width,y*100+100-text.get_height())
-                    )
-                    #pygame.draw.rect(surf,(0,0,0),(x*100+100-10*(i+1),y*100+90,10,10),1)
-        return surf
-    def carOnStreet(self) -> pygame.Surface:
-        rotationToDirection: dict[int,tuple[int,int]] = {
-            0: (1,0),
-            90: (0,0),
-            180: (0,1),
-            270: (1,1)
-        }
-        
-        surf = pygame.surface.Surface(self._visMapSurf.get_size(),pygame.SRCALPHA)
-        for carNum, car in enumerate(self._vehicles):
-            if car.map_position is None or car.road_offset is None or car.current_track_piece is None:
-                # Don't show misaligned or pre-empted vehicles.
+            cell = self._positionCell(position)
+            self._vehicleCells[i] = (position, cell)
+            if cell == oldCell:
                 continue
-            x, y, i = self._lookup[car.map_position]
-            laneOffset = (car.road_offset / 60)*(20 - 5)
-            piece: Element = self._visMap[x][y][i]
-            orientation = piece.orientation
-
-            carImage = self._carIMG.copy()
-            carImage.fill(self._accumulatedVehicleColors[carNum], None, pygame.BLEND_RGB_MULT)
-            if car.current_track_piece.type is not TrackPieceType.CURVE:
-                surf.blit(
-                    rotateSurf(carImage, orientation, -90),
-                    (
-                        x*100+40-laneOffset*orientation[1],
-                        y*100+40+laneOffset*orientation[0]
-                    )
-                )
-            else:
-                laneOffset *= -1 if piece.piece.clockwise else 1
-                laneOffset += 50
-                direction = rotationToDirection[piece.rotation]
-                rotation = math.radians(piece.rotation)
-                curveOffset = (-math.cos(math.pi/4+rotation), math.sin(math.pi/4+rotation))
-                carImage = pygame.transform.rotate(
-                    carImage,
-                    piece.rotation - 135 + (180 if piece.piece.clockwise else 0)
-                )
-                surf.blit(
-                    carImage,
-                    (
-                        x*100 - carImage.get_width()/2  + 100*direction[0] + curveOffset[0]*laneOffset,
-                        y*100 - carImage.get_height()/2 + 100*direction[1] + curveOffset[1]*laneOffset
-                    )
-                )
-                # TODO: Remove this when no longer required (added for testing purposes)
-                # pygame.draw.circle(surf,(255,255,255),
-                #                 (x*100+50,
-                #                  y*100+50),1)
-                # pygame.draw.circle(surf,(0,255,255),
-                #                 (x*100 + 100* direction[0],
-                #                  y*100 + 100* direction[1]),50,1)
-                # pygame.draw.circle(surf,(255,0,0),
-                #                 (x*100 + 100* direction[0] + curveOffset[0]*50,
-                #                  y*100 + 100* direction[1] + curveOffset[1]*50),1)
-                # pygame.draw.circle(surf,(255,0,255),
-                #                 (x*100 + 100* direction[0] + curveOffset[0]*laneOffset,
-                #                  y*100 + 100* direction[1] + curveOffset[1]*laneOffset),2)
+            if oldCell is not None:
+                vehicles = self._occupancy[oldCell]
+                vehicles.remove(i)
+                if not vehicles:
+                    del self._occupancy[oldCell]
+                self._occupancyChanges.add(oldCell)
+            if cell is not None:
+                bisect.insort(self._occupancy.setdefault(cell, []), i)
+                self._occupancyChanges.add(cell)
+    def _cellLabels(self, cell: tuple[int, int]) -> list[tuple[pygame.Surface, tuple[int, int]]]:
+        # The number labels of the vehicles on a cell, right-aligned at its bottom
+        x, y = cell
+        width = 0
+        labels = []
+        for current in self._occupancy[cell]:
+            text = self._textCache.render(self._font, f"{current}", self._design.CarPosText)
+            width += text.get_width()
+            labels.append((text, (x*100+100-width, y*100+100-text.get_height())))
+        return labels
+    def carOnMap(self, surf: pygame.Surface|None = None) ->pygame.Surface:
+        # The occupancy index is shared with the render thread
+        with self._renderLock:
+            if surf is None:
+                surf = pygame.surface.Surface(self._visMapSurf.get_size(),pygame.SRCALPHA)
+            self._updateOccupancy()
+            for cell in sorted(self._occupancy):
+                surf.blits(self._cellLabels(cell), doreturn=False)
+        return surf
+    def carOnStreet(self, surf: pygame.Surface|None = None) -> pygame.Surface:
+        if surf is None:
+            surf = pygame.surface.Surface(self._visMapSurf.get_size(),pygame.SRCALPHA)
+        snapshot = self._snapshot
+        carNums = [
+            carNum for carNum in range(len(snapshot))
+            # Don't show misaligned or pre-empted vehicles.
+            if snapshot.isPlaced(carNum) and snapshot.positions[carNum] < len(self._paths)
+        ]
+        progress = None
+        if self._motion is not None:
+            progress = [self._progress[carNum] for carNum in carNums]
+        placements = self._paths.placeAll(
+            (snapshot.positions[carNum] for carNum in carNums),
+            (snapshot.offsets[carNum] for carNum in carNums),
+            progress
+        )
+        for carNum, (x, y, angle) in zip(carNums, placements):
+            carImage = self._carSprites.get(self._accumulatedVehicleColors[carNum], angle)
+            surf.blit(
+                carImage,
+                (x - carImage.get_width()/2, y - carImage.get_height()/2)
+            )
         return surf
 
     def genButtons(self):
@@ -326,11 +596,29 @@ class Ui:
         return (Button, ScrollSurf), (BtnRect, UpRect, DownRect)
     
     
-    def updateUi(self, carInfoOffset: int, surf: pygame.Surface):
-        surf.fill(self._design.Background)
-        surf.blit(self._visMapSurf, (0, 0))
-        
-        surf.blit(self._eventSurf, (0, self._visMapSurf.get_height()))
+    #layers of the Ui
+    def _vehicleState(self) -> tuple:
+        # Everything the vehicle overlay depends on
+        return (
+            self._design.ShowCarOnStreet,
+            tuple(self._accumulatedVehicleColors),
+            tuple(self._snapshot.positions),
+            tuple(self._snapshot.offsets),
+            tuple(self._snapshot.pieces),
+            # Extrapolated vehicles move about a pixel per hundredth of a piece
+            None if self._motion is None else tuple(
+                round(progress, 2) for progress in self._progress
+            )
+        )
+    def _renderEventLayer(self) -> pygame.Surface:
+        #The lines between messages when using outlines are seen as a feature
+        self._console.render(
+            self._eventSurf,
+            self._font,
+            self._design.EventFill,
+            self._design.Line if self._design.ShowOutlines else None,
+            self._design.LineWidth
+        )
         if self._design.ShowOutlines:
             pygame.draw.rect(
                 self._eventSurf,
@@ -338,71 +626,374 @@ class Ui:
                 self._eventSurf.get_rect(),
                 self._design.LineWidth
             )
-        
-        carInfoSurfs = self.getCarSurfs()
-        carInfoSurfs = carInfoSurfs[carInfoOffset:]
-        for i, carInfoSurf in enumerate(carInfoSurfs):
-            surf.blit(carInfoSurf, (self._visMapSurf.get_width(), carInfoSurf.get_height()*i))
-        
-        if(self._design.ShowCarNumOnMap):
-            surf.blit(self.carOnMap(), (0, 0))
+        return self._eventSurf
+    def _carInfoHeight(self) -> int:
+        return 20+self._design.FontSize*4
+    def _visibleCarInfos(self) -> range:
+        # The numbers of the vehicles whose cards are (partially) visible
+        height = self._carInfoHeight()
+        first = self._carInfoScroll // height
+        last = (self._carInfoScroll + self.UiSurf.get_height() - 1) // height
+        return range(first, min(last+1, len(self._snapshot)))
+    def _scrollCarInfo(self, pixels: float):
+        self._carInfoScroll = min(
+            max(self._carInfoScroll + round(pixels), 0),
+            max(len(self._vehicles)-1, 0)*self._carInfoHeight()
+        )
+    def _renderCarInfoLayer(self) -> pygame.Surface:
+        # Only the visible cards are rendered and kept cached
+        surf = self._carInfoSurf
+        surf.fill(self._design.Background)
+        visible = self._visibleCarInfos()
+        height = self._carInfoHeight()
+        for number in visible:
+            surf.blit(
+                self._carInfoCard(number),
+                (0, number*height - self._carInfoScroll)
+            )
+        for number in [number for number in self._carInfoCards if number not in visible]:
+            del self._carInfoCards[number]
+        return surf
+    def _renderNumberLayer(self) -> pygame.Surface:
+        self._numberSurf.fill((0, 0, 0, 0))
+        self._labelRects = {}
+        if self._design.ShowCarNumOnMap:
+            self._updateOccupancy()
+            for cell in sorted(self._occupancy):
+                self._labelRects[cell] = self._drawLabels(cell)
+        self._occupancyChanges.clear()
+        return self._numberSurf
+    def _drawLabels(self, cell: tuple[int, int]) -> pygame.Rect:
+        rects = self._numberSurf.blits(self._cellLabels(cell))
+        return rects[0].unionall(rects[1:])
+    def _updateNumberLayer(self):
+        # Only redraws the cells whose vehicles changed.
+        # Labels may reach into the cells to their left,
+        # so every label overlapping a redrawn area is drawn again (clipped to it).
+        layer = self._compositor["carNumbers"]
+        if layer.dirty or not self._design.ShowCarNumOnMap:
+            return
+        self._updateOccupancy()
+        changes, self._occupancyChanges = self._occupancyChanges, set()
+        areas = []
+        for cell in changes:
+            area = pygame.Rect(cell[0]*100, cell[1]*100, 100, 100)
+            old = self._labelRects.pop(cell, None)
+            if old is not None:
+                area.union_ip(old)
+            if cell in self._occupancy:
+                rects = [
+                    pygame.Rect(pos, text.get_size())
+                    for text, pos in self._cellLabels(cell)
+                ]
+                self._labelRects[cell] = rects[0].unionall(rects[1:])
+                area.union_ip(self._labelRects[cell])
+            areas.append(area)
+        for area in areas:
+            self._numberSurf.set_clip(area)
+            self._numberSurf.fill((0, 0, 0, 0))
+            for cell, _ in sorted(area.collidedictall(self._labelRects, True)):
+                self._drawLabels(cell)
+            layer.damage(area)
+        self._numberSurf.set_clip(None)
+    def _renderVehicleLayer(self) -> pygame.Surface:
+        self._overlaySurf.fill((0, 0, 0, 0))
         if(self._design.ShowCarOnStreet):
-            surf.blit(self.carOnStreet(), (0, 0))
+            self.carOnStreet(self._overlaySurf)
+        return self._overlaySurf
+    def _hudLines(self) -> list[tuple[str, ...]]:
+        # The rows of the HUD table, times in milliseconds
+        stats = self._profiler.stats()
+        frame = stats.stages["frame"]
+        lines = [
+            (f"{stats.frames} frames", "mean", "p95", "p99"),
+            ("frame", f"{frame.mean*1000:.1f}", f"{frame.p95*1000:.1f}", f"{frame.p99*1000:.1f}")
+        ]
+        for stage in FRAME_STAGES[:-1]:
+            times = stats.stages[stage]
+            lines.append((stage, f"{times.mean*1000:.1f}", f"{times.p95*1000:.1f}", f"{times.p99*1000:.1f}"))
+        return lines
+    def _hudSize(self) -> tuple[int, int]:
+        return (HUD_WIDTH, (len(FRAME_STAGES)+1)*self._hudFont.get_linesize() + HUD_SPARKLINE_HEIGHT + 10)
+    def _renderHudLayer(self) -> pygame.Surface:
+        # Frame times by stage and a sparkline of the recent frame times
+        if not self._hudVisible:
+            return pygame.surface.Surface((0, 0))
+        surf = pygame.surface.Surface(self._hudSize(), pygame.SRCALPHA)
+        surf.fill((*self._design.EventFill, 235))
+        lineHeight = self._hudFont.get_linesize()
+        for row, line in enumerate(self._hudLines()):
+            for column, text in enumerate(line):
+                rendered = self._hudFont.render(text, True, self._design.Text)
+                if column == 0:
+                    surf.blit(rendered, (5, row*lineHeight))
+                else:
+                    # Numbers are right-aligned
+                    surf.blit(rendered, (HUD_WIDTH - 5 - (3-column)*60 - rendered.get_width(), row*lineHeight))
+        times = self._profiler.recent("frame", HUD_SPARKLINE_FRAMES)
+        if len(times) > 1:
+            top = surf.get_height() - HUD_SPARKLINE_HEIGHT - 5
+            budget = 1/self.fps
+            scale = max(max(times), budget)
+            step = (HUD_WIDTH-10)/(HUD_SPARKLINE_FRAMES-1)
+            # The time between frames at fps, frames above it are too slow
+            budgetY = top + HUD_SPARKLINE_HEIGHT*(1 - budget/scale)
+            pygame.draw.line(surf, self._design.CarPosText, (5, budgetY), (HUD_WIDTH-5, budgetY))
+            pygame.draw.lines(surf, self._design.Text, False, [
+                (5 + i*step, top + HUD_SPARKLINE_HEIGHT*(1 - seconds/scale))
+                for i, seconds in enumerate(times)
+            ])
+        return surf
+    def toggleHud(self):
+        """Shows or hides the performance HUD"""
+        self._hudVisible = not self._hudVisible
+        self._wake()
+    def _setupLayers(self):
+        self._overlaySurf = pygame.surface.Surface(self._visMapSurf.get_size(), pygame.SRCALPHA)
+        self._numberSurf = pygame.surface.Surface(self._visMapSurf.get_size(), pygame.SRCALPHA)
+        self._carInfoSurf = pygame.surface.Surface((CAR_INFO_WIDTH, self.UiSurf.get_height()))
+        compositor = Compositor(self.UiSurf, self._design.Background)
+        compositor.addLayer("map", lambda: self._visMapSurf)
+        compositor.addLayer(
+            "events",
+            self._renderEventLayer,
+            (0, self._visMapSurf.get_height())
+        )
+        # Layers have no rect until they are first drawn, input is hit-tested against this instead
+        self._consoleRect = pygame.Rect(
+            (0, self._visMapSurf.get_height()),
+            (self._visMapSurf.get_width(), self._design.ConsoleHeight)
+        )
+        compositor.addLayer(
+            "carInfo",
+            self._renderCarInfoLayer,
+            (self._visMapSurf.get_width(), 0),
+            lambda: (
+                self._carInfoScroll,
+                tuple(self._carInfoKey(i) for i in self._visibleCarInfos())
+            )
+        )
+        compositor.addLayer(
+            "carNumbers",
+            self._renderNumberLayer,
+            key=lambda: self._design.ShowCarNumOnMap
+        )
+        compositor.addLayer("vehicles", self._renderVehicleLayer, key=self._vehicleState)
+        compositor.addLayer(
+            "hud",
+            self._renderHudLayer,
+            (0, max(self._visMapSurf.get_height() - self._hudSize()[1], 0)),
+            lambda: (
+                self._hudVisible,
+                round(time.perf_counter()*HUD_REFRESH_RATE) if self._hudVisible else None
+            )
+        )
+        self._compositor = compositor
+    
+    def _resizeUi(self):
+        # Resizes all surfaces depending on the size of the map surface
+        self.UiSurf = pygame.surface.Surface(
+            (self._visMapSurf.get_width() + CAR_INFO_WIDTH,
+                self._visMapSurf.get_height() + self._design.ConsoleHeight))
+        if(self.showUi):
+            ((self._ControlButtonSurf, self._ScrollSurf), self._rects) = self.genButtons()
+        
+        # The event layer redraws the console onto it
+        self._eventSurf = pygame.Surface((
+            self._visMapSurf.get_width(),
+            self._design.ConsoleHeight
+        ))
+        self._setupLayers()
+    def _compose(self, carInfoScroll: int) -> list[pygame.Rect]:
+        # Redraws the parts of UiSurf that changed and returns the damaged rects
+        with self._renderLock:
+            profiler = self._profiler
+            profiler.beginFrame()
+            self._applyMapChanges()
+            start = time.perf_counter()
+            self._takeSnapshot()
+            profiler.record("snapshot", time.perf_counter()-start)
+            start = time.perf_counter()
+            self._updateNumberLayer()
+            profiler.record("carNumbers", time.perf_counter()-start)
+            if self._console.drain():
+                self._compositor.invalidate("events")
+            # Frames drawn at another offset (see updateUi) keep the user's scroll position
+            userScroll, self._carInfoScroll = self._carInfoScroll, carInfoScroll
+            damage = self._compositor.compose()
+            self._carInfoScroll = userScroll
+            for layer, seconds in self._compositor.layerTimes.items():
+                profiler.record(layer, seconds)
+            profiler.record("composite", self._compositor.compositeTime)
+            if self.showUi or self._headless:
+                self._damage.extend(damage)
+            return damage
+    def _takeSnapshot(self):
+        # Reads the vehicles for the next frame
+        self._snapshot.capture(self._vehicles)
+        if self._motion is not None:
+            self._progress = self._motion.progress(self._snapshot)
+        if self._recorder is not None:
+            self._recorder.record(self._snapshot)
+    def _takeDamage(self) -> list[pygame.Rect]:
+        # Returns and clears the damage that wasn't shown yet
+        with self._renderLock:
+            damage, self._damage = self._damage, []
+            return damage
+    def updateUi(self, carInfoOffset: float, surf: pygame.Surface):
+        """
+        Draws the Ui onto surf.
+
+        :param carInfoOffset: The number of car info cards scrolled past,
+            fractions scroll part of a card
+        """
+        self._compose(round(carInfoOffset*self._carInfoHeight()))
+        if surf is not self.UiSurf:
+            surf.blit(self.UiSurf, (0, 0))
         return surf
     
     #The Code that showeth the Ui (:D)
     def _UiThread(self):
-        self.genMapSurface(self._visMap)
+        self._loadMapSurface()
         self._eventSurf = pygame.Surface((
             self._visMapSurf.get_width(),
             self._design.ConsoleHeight
         ))
-        self._eventSurf.fill(self._design.EventFill)
         self.addEvent("Started Ui", self._design.Text)
         uiSize = (
             self._visMapSurf.get_width() + CAR_INFO_WIDTH,
             self._visMapSurf.get_height() + self._design.ConsoleHeight
         )
         if self.showUi:
-            Logo = load_image("logo.png")
+            Logo = getImage("Logo.png")
             pygame.display.set_icon(Logo)
             pygame.display.set_caption("Anki Ui Access")
             ((self._ControlButtonSurf, self._ScrollSurf), self._rects) = self.genButtons()
             Ui = pygame.display.set_mode(uiSize, pygame.SCALED)
         self.UiSurf = pygame.surface.Surface(uiSize)
-        carInfoOffset = 0
+        self._setupLayers()
         
         self._uiSetupComplete.set_result(True)
         clock = pygame.time.Clock()
+        while(self._run and self._headless):
+            frameStart = time.perf_counter()
+            self._compose(self._carInfoScroll)
+            displayStart = time.perf_counter()
+            self._publishFrame()
+            self._profiler.record("display", time.perf_counter()-displayStart)
+            waitStart = time.perf_counter()
+            clock.tick(self._paceFrame(waitStart-frameStart))
+            self._nextEvents()
+            self._profiler.record("wait", time.perf_counter()-waitStart)
         while(self._run and self.showUi):
-            self.updateUi(carInfoOffset, self.UiSurf)
+            frameStart = time.perf_counter()
+            self._compose(self._carInfoScroll)
+            displayStart = time.perf_counter()
+            damage = self._takeDamage()
+            
+            if Ui.get_size() != self.UiSurf.get_size():
+                Ui = pygame.display.set_mode(self.UiSurf.get_size(), pygame.SCALED)
+                damage = [Ui.get_rect()]
+            # Only the damaged parts of the window are redrawn.
+            # The buttons are translucent, so they may only be drawn over fresh pixels.
+            for rect in damage:
+                Ui.set_clip(rect)
+                Ui.blit(self.UiSurf, (0, 0))
+                Ui.blit(self._ControlButtonSurf, (0, 0))
+                Ui.blit(self._ScrollSurf, (self._visMapSurf.get_width()-self._ScrollSurf.get_width(), 0))
+            Ui.set_clip(None)
             
-            for event in pygame.event.get():
+            pygame.display.update(damage)
+            self._profiler.record("display", time.perf_counter()-displayStart)
+            waitStart = time.perf_counter()
+            clock.tick(self._paceFrame(waitStart-frameStart))
+            
+            events = self._nextEvents()
+            self._profiler.record("wait", time.perf_counter()-waitStart)
+            for event in events:
                 if event.type == pygame.QUIT:
                     self._run = False
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                    self.toggleHud()
                 if event.type == pygame.MOUSEBUTTONDOWN:
                     if self._rects[0].collidepoint(pygame.mouse.get_pos()):
                         self.startVehicleControlUI()
                     if self._rects[1].collidepoint(pygame.mouse.get_pos()):
-                        self._carInfoOffset = min(max(self._carInfoOffset+1, 0), len(self._vehicles)-1)
+                        self._scrollCarInfo(self._carInfoHeight())
                     if self._rects[2].collidepoint(pygame.mouse.get_pos()):
-                        self._carInfoOffset = min(max(self._carInfoOffset-1, 0), len(self._vehicles)-1)
+                        self._scrollCarInfo(-self._carInfoHeight())
                 if event.type == pygame.MOUSEWHEEL:
-                    carInfoOffset = min(
-                        max(carInfoOffset + event.y, 0),
-                        len(self._vehicles)-1
-                    )
-            
-            if Ui.get_size() != self.UiSurf.get_size():
-                Ui = pygame.display.set_mode(self.UiSurf.get_size(), pygame.SCALED)
-            Ui.blit(self.UiSurf, (0, 0))
-            Ui.blit(self._ControlButtonSurf, (0, 0))
-            Ui.blit(self._ScrollSurf, (self._visMapSurf.get_width()-self._ScrollSurf.get_width(), 0))
-            
-            pygame.display.update()
-            clock.tick(self.fps)
+                    if self._consoleRect.collidepoint(pygame.mouse.get_pos()):
+                        self._console.scrollBy(event.y)
+                        self._compositor.invalidate("events")
+                    else:
+                        self._scrollCarInfo(event.precise_y*CAR_INFO_SCROLL_STEP)
+    
+    def _paceFrame(self, frameTime: float) -> float:
+        # The frame rate to wait for after a frame took frameTime seconds
+        if self._pacer is None:
+            return self.fps
+        self._pacer.maxFps = self.fps
+        return self._pacer.frameDone(self._snapshot, frameTime)
+    def _nextEvents(self) -> list[pygame.event.Event]:
+        # Event driven Ui's sleep until something changed or the heartbeat is due.
+        # fps still caps the frame rate, since this is called after clock.tick
+        if not self._eventDriven:
+            return pygame.event.get()
+        event = pygame.event.wait(round(self.heartbeat*1000))
+        self._wakePending = False
+        return [event] + pygame.event.get()
+    def _wake(self):
+        # Wakes an event driven Ui to draw a new frame. Can be called from any thread
+        if self._eventDriven and not self._wakePending:
+            self._wakePending = True
+            pygame.event.post(pygame.event.Event(_WAKE_EVENT))
+    def _watchVehicle(self, vehicle: anki.Vehicle):
+        # Vehicles without notifications (e.g. stand-ins) are still drawn on heartbeats
+        # and extrapolated from the frame that first saw them on a piece
+        if self._motion is not None and hasattr(vehicle, "track_piece_change"):
+            motion = self._motion
+            watcher = self._motionWatchers[id(vehicle)] = lambda: motion.notify(vehicle.id)
+            vehicle.track_piece_change(watcher)
+        if not self._eventDriven:
+            return
+        if hasattr(vehicle, "track_piece_change"):
+            vehicle.track_piece_change(self._wake)
+        if hasattr(vehicle, "delocalized"):
+            vehicle.delocalized(self._wake)
+    def _unwatchVehicle(self, vehicle: anki.Vehicle):
+        watchers = [
+            ("remove_track_piece_watcher", self._wake),
+            ("remove_delocalized_watcher", self._wake)
+        ]
+        if id(vehicle) in self._motionWatchers:
+            watchers.append(("remove_track_piece_watcher", self._motionWatchers.pop(id(vehicle))))
+        for remove, watcher in watchers:
+            try:
+                getattr(vehicle, remove)(watcher)
+            except (AttributeError, ValueError):
+                pass
     
     
+    def _publishFrame(self):
+        # Brings the back buffer up to date and swaps it to the front.
+        # The back buffer missed the damage of the previous frame as well.
+        with self._renderLock:
+            damage, self._damage = self._damage, []
+            if not self._frames or self._frames[0].get_size() != self.UiSurf.get_size():
+                self._frames = [self.UiSurf.copy(), self.UiSurf.copy()]
+            elif self._frames[1-self._frontFrame].get_locked():
+                # A reader still holds a view of the old frame, so it is left to them
+                self._frames[1-self._frontFrame] = self.UiSurf.copy()
+            else:
+                back = self._frames[1-self._frontFrame]
+                for rect in self._lastFrameDamage + damage:
+                    back.blit(self.UiSurf, rect, rect)
+        self._lastFrameDamage = damage
+        with self._frameLock:
+            self._frontFrame = 1-self._frontFrame
+            self._frameSequence += 1
+    
     def __eventWrapper(self):
         try:
             self._UiThread()
@@ -411,6 +1002,7 @@ class Ui:
         else:
             self._endFuture.set_result(True)
         finally:
+            self.stopRecording()
             if not self._endFuture.done():
                 self._endFuture.set_result(False)
     
@@ -418,29 +1010,125 @@ class Ui:
     #methods for user interaction
     def kill(self):
         self._run = False
-    def addEvent(self, text: str, color: tuple[int, int, int]|None = None):
-        if self._eventSurf is None:
-            warnings.warn("Ui.addEvent called before Ui was initialized", RuntimeWarning)
-            return
-        event = self._font.render(
-            text,
-            True,
-            color if color != None else (0, 0, 0),
-            self._design.EventFill
-        )
-        #The lines between messages when using outlines apear due to using scroll 
-        # this is seen as a feature
-        self._eventSurf.scroll(dy=event.get_height())
-        pygame.draw.rect(
-            self._eventSurf,
-            self._design.EventFill,
-            (0, 0, self._eventSurf.get_width(), event.get_height())
-        )
-        self._eventSurf.blit(event, (10, 0))
+        self._wake()
+        for vehicle in self._vehicles:
+            self._unwatchVehicle(vehicle)
+    def addEvent(
+            self,
+            text: str,
+            color: tuple[int, int, int]|None = None,
+            severity: int = logging.INFO
+        ):
+        """
+        Adds a line to the event console. Can be called from any thread.
+
+        :param severity: A `logging` level, used by `Ui.setEventFilter`
+        """
+        self._console.push(text, color if color != None else (0, 0, 0), severity)
+        self._wake()
+    def scrollEvents(self, lines: int):
+        """Scrolls the event console back (positive) or forward (negative)"""
+        with self._renderLock:
+            self._console.scrollBy(lines)
+        self._invalidateEvents()
+    def setEventFilter(self, minSeverity: int):
+        """Only shows events with at least the given `logging` level"""
+        with self._renderLock:
+            self._console.minSeverity = minSeverity
+            self._console.scroll = 0
+        self._invalidateEvents()
+    def getEventStats(self) -> EventStats:
+        return self._console.stats()
+    def _invalidateEvents(self):
+        if hasattr(self, "_compositor"):
+            self._compositor.invalidate("events")
+        self._wake()
+    @contextlib.contextmanager
+    def readFrame(self, kind: str = "3") -> Iterator[tuple[int, pygame.BufferProxy]]:
+        """
+        Zero-copy access to the latest frame of a headless Ui.
+
+        Yields the frame sequence number and a view of the frame's pixels
+        (see `pygame.Surface.get_view` for the view kinds).
+        The frame isn't replaced while the context is open,
+        so the view must not be used after leaving it.
+        """
+        if not self._headless:
+            raise RuntimeError("Frames can only be read from headless Ui's")
+        with self._frameLock:
+            if not self._frames:
+                raise RuntimeError("No frame has been rendered yet")
+            view = self._frames[self._frontFrame].get_view(kind)
+            try:
+                yield self._frameSequence, view
+            finally:
+                del view
+    @contextlib.contextmanager
+    def readFrameArray(self) -> Iterator[tuple[int, object]]:
+        """
+        Same as `Ui.readFrame`, but yields a NumPy array view of shape (width, height, 3).
+        Requires NumPy to be installed.
+        """
+        with self.readFrame("3") as (sequence, _):
+            pixels = pygame.surfarray.pixels3d(self._frames[self._frontFrame])
+            try:
+                yield sequence, pixels
+            finally:
+                del pixels
+    def getFrameStats(self) -> FrameStats:
+        """Statistics of how long the stages of recent frames took (see `FrameProfiler.FRAME_STAGES`)"""
+        with self._renderLock:
+            return self._profiler.stats()
+    def getPacingStats(self) -> PacingStats|None:
+        """Statistics of the frame rates chosen so far, None if the frame rate isn't adaptive"""
+        if self._pacer is None:
+            return None
+        return self._pacer.stats()
+    def getCommandLatency(
+            self,
+            vehicleId=None,
+            command: str|None = None,
+            stage: str = "ack"
+        ) -> LatencyHistogram:
+        """
+        The latencies of the commands sent through `fleet`,
+        merged over all vehicles and commands unless they are given.
+
+        :param stage: "ack" until the vehicles acknowledged the commands,
+            "telemetry" until their telemetry reflected them
+        """
+        return self.fleet.latency.histogram(vehicleId, command, stage)
+    def getSnapshot(self) -> VehicleSnapshot:
+        """A copy of the vehicle state the latest frame was drawn from"""
+        with self._renderLock:
+            return self._snapshot.copy()
+    def startRecording(self, file: str|BinaryIO):
+        """
+        Records the vehicle states of every following frame and the map to a telemetry log,
+        which `TelemetryReplay` can play back. A running recording is stopped first.
+        """
+        with self._renderLock:
+            if self._recorder is not None:
+                self._recorder.close()
+            self._recorder = TelemetryRecorder(file, self._map, self._snapshot.laneTable)
+    def stopRecording(self):
+        with self._renderLock:
+            if self._recorder is not None:
+                self._recorder.close()
+                self._recorder = None
+    @property
+    def frameSequence(self) -> int:
+        """The sequence number of the latest headless frame"""
+        return self._frameSequence
     def getUiSurf(self, surf: pygame.Surface|None=None) -> pygame.Surface: 
-        return self.updateUi(0, surf or self.UiSurf)
+        surf = surf or self.UiSurf
+        self._compose(self._carInfoScroll)
+        if surf is not self.UiSurf:
+            surf.blit(self.UiSurf, (0, 0))
+        return surf
     def getCarSurfs(self) -> list[pygame.Surface]:
-        return [self.carInfo(self._vehicles[i], i) for i in range(len(self._vehicles)) ]
+        with self._renderLock:
+            return [self._carInfoCard(i) for i in range(len(self._snapshot)) ]
     def getMapsurf(self) -> pygame.Surface:
         return self._visMapSurf
     def getCarsOnMap(self) -> pygame.Surface:
@@ -448,44 +1136,59 @@ class Ui:
     def getEventSurf(self) -> pygame.Surface:
         return self._eventSurf
     def updateDesign(self):
-        self.genMapSurface(self._visMap)
-        self.UiSurf = pygame.surface.Surface(
-            (self._visMapSurf.get_width() + self.getCarSurfs()[0].get_width(),
-                self._visMapSurf.get_height() + self._design.ConsoleHeight))
-        if(self.showUi):
-            ((self._ControlButtonSurf, self._ScrollSurf), self._rects) = self.genButtons()
-        
-        old_eventSurf = self._eventSurf
-        # TODO: Fix code duplication with _UiThread
-        self._eventSurf = pygame.Surface((
-            self._visMapSurf.get_width(),
-            self._design.ConsoleHeight
-        ))
-        self._eventSurf.blit(old_eventSurf, (0, 0))
+        with self._renderLock:
+            self._hudVisible = self._design.ShowPerformanceHud
+            self._carInfoCards.clear()
+            self._loadMapSurface()
+            self._resizeUi()
+        self._wake()
     def setDesign(self, design: Design):
         self._design = design
         self.updateDesign()
     
+    def appendPiece(self, piece: anki.TrackPiece):
+        """Adds a track piece to the end of the map, e.g. while the track is being scanned"""
+        self._mapChanges.append(("append", piece))
+        self._wake()
+    def setMap(self, map: list[anki.TrackPiece]):
+        """
+        Replaces the map.
+        When the new map extends the current one, the existing layout is reused.
+        """
+        self._mapChanges.append(("set", list(map)))
+        self._wake()
+    
     def addVehicle(
             self,
             vehicle: anki.Vehicle,
             vehicleColor: tuple[int,int,int]|None = None
         ):
-        self._vehicles.append(vehicle)
         if vehicleColor is None:
-            self._accumulatedVehicleColors.append(next(self._vehicleColorIterator))
-        else:
+            vehicleColor = next(self._vehicleColorIterator)
+        # The render thread indexes the colours by snapshot row,
+        # so the snapshot is retaken along with the change
+        with self._renderLock:
+            self._vehicles.append(vehicle)
             self._accumulatedVehicleColors.append(vehicleColor)
+            self._carSprites.add(vehicleColor)
+            self._takeSnapshot()
+        self._watchVehicle(vehicle)
+        self._wake()
     
     def removeVehicle(self,index: int):
-        self._vehicles.pop(index)
-        self._accumulatedVehicleColors.pop(index)
+        with self._renderLock:
+            vehicle = self._vehicles.pop(index)
+            self._carInfoCards.pop(len(self._vehicles), None)
+            self._carSprites.remove(self._accumulatedVehicleColors.pop(index))
+            self._takeSnapshot()
+        self._unwatchVehicle(vehicle)
+        self._wake()
     
     def startVehicleControlUI(self): #modify starting condition
         if self._controlThread is None or not self._controlThread.is_alive():
             self._controlThread = threading.Thread(
                 target=vehicleControler,
-                args=(self._vehicles,self._eventLoop,self._customLanes),
+                args=(self._vehicles,self._eventLoop,self._customLanes,self.fleet),
                 daemon=True
             )
             self._controlThread.start()
@@ -526,4 +1229,18 @@ class Ui:
     
     def __exit__(self, exc_type, traceback,_) -> None:
         self.kill()
-    pass
\ No newline at end of file
+    pass
+
+
+def createUi(*args, renderProcess: bool = False, **kwargs):
+    """
+    Creates a Ui, taking the same arguments as `Ui`.
+
+    :param renderProcess: Whether the Ui is drawn by a separate process,
+        which returns a `RenderProcess.RemoteUi`
+    """
+    if not renderProcess:
+        return Ui(*args, **kwargs)
+    from RenderProcess import RemoteUi
+    # RemoteUi only takes the vehicles and the map positionally
+    return RemoteUi(**inspect.signature(Ui).bind(*args, **kwargs).arguments)
@@ -1,43 +1,59 @@
 import anki
 from anki.misc.lanes import BaseLane
 import asyncio
+import concurrent.futures
 from tkinter import *
 from tkinter import ttk as ttk
+
+from FleetCommands import FleetCommands, FleetResult
+from LaneTable import LaneTable
 class vehicleControler:
     
+    def _selected(self,vehicleSelection:list[IntVar]) -> list[int]:
+        return [i for i in range(len(vehicleSelection)) if vehicleSelection[i].get() == 1]
+    def _report(self,future:concurrent.futures.Future[FleetResult]):
+        # Tk may only be used from its own thread, so the result is polled
+        if not future.done():
+            self.root.after(50, self._report, future)
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            self.status.set(f"Failed: {e}")
+            return
+        status = f"{result.command}: {len(result.results)-len(result.failures)}/{len(result.results)} ok in {result.latency*1000:.0f} ms"
+        if result.sent < len(result.results):
+            status += f", {len(result.results)-result.sent} skipped"
+        for failure in result.failures:
+            status += f"\nVehicle {failure.index}: {failure.error}"
+        self.status.set(status)
     def startVehicle(self,speed:IntVar,vehicleSelection:list[IntVar]):
-        from time import perf_counter
-        async def setSpeedTask(i):
-            await self.vehicles[i].setSpeed(speed.get())
-        for i in range(len(vehicleSelection)):
-            if(vehicleSelection[i].get() == 1):
-                asyncio.run_coroutine_threadsafe(setSpeedTask(i),self.eventLoop)
+        self._report(self.fleet.setSpeed(speed.get(), vehicles=self._selected(vehicleSelection)))
     def stopVehicle(self,vehicleSelection:list[IntVar]):
-        for i in range(len(vehicleSelection)):
-            if(vehicleSelection[i].get() == 1):
-                asyncio.run_coroutine_threadsafe(self.vehicles[i].stop(),self.eventLoop)
+        self._report(self.fleet.stop(self._selected(vehicleSelection)))
     def changeLane(self,vehicleSelection: list[IntVar],lane:StringVar,laneSpeed: IntVar):
-        ln = next(filter(lambda x: x.lane_name == lane.get(),self.lanes))
-        for i in range(len(vehicleSelection)):
-            if(vehicleSelection[i].get() == 1):
-                asyncio.run_coroutine_threadsafe(self.vehicles[i].change_lane(ln,laneSpeed.get()),
-                                                 self.eventLoop)
+        ln = self._laneTable.byName(lane.get())
+        self._report(self.fleet.changeLane(ln, laneSpeed.get(), vehicles=self._selected(vehicleSelection)))
     def alignVehicle(self, vehicleSelection:list[IntVar]):
-        for i in range(len(vehicleSelection)):
-            if(vehicleSelection[i].get() == 1):
-                asyncio.run_coroutine_threadsafe(self.vehicles[i].align(),self.eventLoop)
+        self._report(self.fleet.align(vehicles=self._selected(vehicleSelection)))
     
     def __init__(
         self,
         vehicles:list[anki.Vehicle], 
         eventLoop:asyncio.AbstractEventLoop,
-        lanes:list[BaseLane]=[]
+        lanes:list[BaseLane]=[],
+        fleet:FleetCommands|None=None
     ) -> None:
         self.vehicles = vehicles
         self.eventLoop:asyncio.AbstractEventLoop = eventLoop
+        # Commands are sent to all selected vehicles at once
+        self.fleet = fleet or FleetCommands(vehicles, eventLoop)
         self.lanes = lanes
+        self._laneTable = LaneTable(lanes)
         root = Tk()
         root.title("Vehicle Control")
+        self.root = root
+        self.status = StringVar(root)
         
         frm = ttk.Frame(root, padding=10)
         frm.grid()
@@ -75,5 +91,7 @@ class vehicleControler:
         lcsFrm.grid(column=0,row=2,columnspan=2)
         ttk.Label(lcsFrm,text="Lane change Speed:").grid(column=0,row=0)
         Scale(lcsFrm,from_=100,to=400,variable= laneSpeed,orient="horizontal").grid(column=1,row=0,columnspan=2)
+        #result of the last command
+        ttk.Label(frm,textvariable=self.status).grid(column=0,row=3,columnspan=3)
         
         root.mainloop()
\ No newline at end of file
@@ -0,0 +1,102 @@
+import math
+import time
+from array import array
+from typing import Iterable
+
+import anki
+from anki import TrackPieceType
+from anki.misc.lanes import BaseLane
+
+from LaneTable import LaneTable
+from VisMapGenerator import PIECE_TYPES
+
+_PIECE_INDICES = {pieceType: i for i, pieceType in enumerate(PIECE_TYPES)}
+
+
+class VehicleSnapshot:
+    """
+    The state of all vehicles at one moment, stored column by column.
+
+    Each column is an `array` with one entry per vehicle.
+    Missing values are NaN (`offsets`, `speeds`) or -1 (`positions`, `lanes`, `pieces`).
+    `lanes` index into `laneTable.lanes`, `pieces` into `VisMapGenerator.PIECE_TYPES`.
+    Lanes are only looked up again when the road offset of a vehicle changed.
+    The arrays are reused by every capture, so they must be copied to be kept.
+    """
+    def __init__(self, laneSystem: type[BaseLane]|LaneTable) -> None:
+        if not isinstance(laneSystem, LaneTable):
+            laneSystem = LaneTable(laneSystem)
+        self.laneTable = laneSystem
+        self.ids = array("q")
+        self.positions = array("i")
+        self.offsets = array("d")
+        self.speeds = array("d")
+        self.lanes = array("i")
+        self.pieces = array("i")
+        self.sequence = 0
+        """The number of captures so far"""
+        self.time = 0.
+        """When the snapshot was captured (from `time.perf_counter`)"""
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _resize(self, count: int):
+        # Columns only grow or shrink when vehicles are added or removed
+        for column in (self.ids, self.positions, self.offsets, self.speeds, self.lanes, self.pieces):
+            if len(column) < count:
+                column.extend(array(column.typecode, bytes(column.itemsize*(count-len(column)))))
+            else:
+                del column[count:]
+
+    def capture(self, vehicles: Iterable[anki.Vehicle]):
+        """Copies the state of the vehicles, reading every attribute once"""
+        vehicles = list(vehicles)
+        resized = len(vehicles) != len(self)
+        if resized:
+            self._resize(len(vehicles))
+        laneIndex = self.laneTable.index
+        for i, vehicle in enumerate(vehicles):
+            self.ids[i] = vehicle.id
+            position = vehicle.map_position
+            self.positions[i] = -1 if position is None else position
+            offset = vehicle.road_offset
+            if offset is None:
+                offset = math.nan
+            if resized or offset != self.offsets[i]:
+                # The lane only depends on the offset
+                self.lanes[i] = laneIndex(offset)
+            self.offsets[i] = offset
+            speed = vehicle.speed
+            self.speeds[i] = math.nan if speed is None else speed
+            piece = vehicle.current_track_piece
+            self.pieces[i] = -1 if piece is None else _PIECE_INDICES[piece.type]
+        self.sequence += 1
+        self.time = time.perf_counter()
+
+    def copy(self) -> "VehicleSnapshot":
+        snapshot = VehicleSnapshot(self.laneTable)
+        for name in ("ids", "positions", "offsets", "speeds", "lanes", "pieces"):
+            setattr(snapshot, name, array(getattr(self, name).typecode, getattr(self, name)))
+        snapshot.sequence = self.sequence
+        snapshot.time = self.time
+        return snapshot
+
+    def getPosition(self, i: int) -> int|None:
+        return None if self.positions[i] < 0 else self.positions[i]
+
+    def getOffset(self, i: int) -> float|None:
+        return None if math.isnan(self.offsets[i]) else self.offsets[i]
+
+    def getSpeed(self, i: int) -> float|None:
+        return None if math.isnan(self.speeds[i]) else self.speeds[i]
+
+    def getLane(self, i: int) -> BaseLane|None:
+        return None if self.lanes[i] < 0 else self.laneTable.lanes[self.lanes[i]]
+
+    def getPieceType(self, i: int) -> TrackPieceType|None:
+        return None if self.pieces[i] < 0 else PIECE_TYPES[self.pieces[i]]
+
+    def isPlaced(self, i: int) -> bool:
+        """Whether the vehicle is aligned and reported its offset and piece"""
+        return self.positions[i] >= 0 and self.pieces[i] >= 0 and not math.isnan(self.offsets[i])
@@ -1,9 +1,10 @@
 from warnings import warn
 from anki import TrackPiece, TrackPieceType
+from array import array
 from dataclasses import dataclass
 from typing import Literal
 
-__all__ = ("generate",)
+__all__ = ("generate", "VismapBuilder", "CompactVismap")
 
 
 Vismap = list[list[list["Element"]]]
@@ -34,44 +35,6 @@ def _invert_orientation(o: Orientation) -> Orientation:
     return (-o[0],-o[1])
     pass
 
-def _expand_right(vismap: Vismap):
-    vismap.append(
-        [[] for _ in range(len(vismap[0]))]
-        # len(vismap[0]) is the column length (i.e. row count)
-    )
-    pass
-
-def _expand_left(vismap: Vismap, position_tracker: PositionTracker):
-    vismap.insert(
-        0,
-        [[] for _ in range(len(vismap[0]))]
-        # len(vismap[0]) is the column length (i.e. row count)
-    )
-
-    prev_tracker = position_tracker.copy()
-    position_tracker.clear()
-    for x,y,z in prev_tracker:
-        position_tracker.append((x+1,y,z))
-        pass
-    pass
-
-def _expand_up(vismap: Vismap, position_tracker: PositionTracker):
-    for column in vismap:
-        column.insert(0,[])
-        pass
-    
-    prev_tracker = position_tracker.copy()
-    position_tracker.clear()
-    for x,y,z in prev_tracker:
-        position_tracker.append((x,y+1,z))
-    pass
-
-def _expand_down(vismap: Vismap):
-    for column in vismap:
-        column.append([])
-        pass
-    pass
-
 _CURVE_ROTATIONS_LOOKUP: dict[tuple[Orientation, Orientation],int] = {
     ((1,0),(0,-1)) : 0,
     ((-1,0),(0,-1)) : 90,
@@ -113,87 +76,118 @@ def orientation_to_rotation(
         raise RuntimeError
     pass
 
-def generate(
-    track_map: list[TrackPiece],
-    orientation: tuple[int,int] = (1,0)
-) -> tuple[Vismap,PositionTracker]:
-    """Creates a 3d map of the track from the 1d version passed as an argument"""
-    if orientation not in _ORIENTATIONS:
-        raise ValueError(f"Passed orientation is not valid. Must be one of {_ORIENTATIONS}")
-
-    vismap: Vismap = [[[]]]
-    position_tracker = []
-
-    head = [0,0]
-    previous_orientation = orientation
-    for piece in track_map:
-        head[0] += orientation[0]
-        head[1] += orientation[1]
-
-        # Adjust vismap when needed
-        if head[0] > len(vismap)-1: 
-            # If not enough columns to the right
-            _expand_right(vismap)
-            pass
-        elif head[0] < 0: 
-            # If not enough columns to the left
-            _expand_left(vismap,position_tracker)
-            head[0]+=1
-            pass
-        if head[1] > len(vismap[0])-1:
-            # If not enough rows down
-            _expand_down(vismap)
-            pass
-        elif head[1] < 0:
-            # If not enough rows up
-            _expand_up(vismap,position_tracker)
-            head[1]+=1
-            # Incrementing head, because the vismap has now shifted
-            pass
+SparseVismap = dict[tuple[int,int],list["Element"]]
+
+class VismapBuilder:
+    """
+    Lays out a track one piece at a time.
+
+    Pieces are placed on unbounded coordinates,
+    so appending never has to shift the cells placed before.
+    `build` normalizes the layout into a vismap and position tracker,
+    the same way `generate` does for a complete track.
+    """
+    def __init__(self, orientation: tuple[int,int] = (1,0)) -> None:
+        if orientation not in _ORIENTATIONS:
+            raise ValueError(f"Passed orientation is not valid. Must be one of {_ORIENTATIONS}")
+        # The origin is always part of the map.
+        self.cells: SparseVismap = {(0,0): []}
+        self.positions: PositionTracker = []
+        self.pieces: list[TrackPiece] = []
+        self.bounds = (0,0,0,0)
+        """The min x, min y, max x and max y of all cells"""
+        self._head = (0,0)
+        self._orientation: Orientation = orientation
+        self._previous_orientation: Orientation = orientation
+        pass
+
+    @property
+    def size(self) -> tuple[int,int]:
+        min_x, min_y, max_x, max_y = self.bounds
+        return max_x-min_x+1, max_y-min_y+1
+
+    def append(self, piece: TrackPiece, _stacklevel: int = 2) -> tuple[int,int]:
+        """Places the next piece and returns the (unnormalized) cell it was placed in"""
+        # _stacklevel is the stacklevel of the intersection warning,
+        # so it points at the code using the builder
+        orientation = self._orientation
+        head_x = self._head[0] + orientation[0]
+        head_y = self._head[1] + orientation[1]
+        self._head = (head_x,head_y)
+
+        min_x, min_y, max_x, max_y = self.bounds
+        self.bounds = (
+            min(min_x,head_x),
+            min(min_y,head_y),
+            max(max_x,head_x),
+            max(max_y,head_y)
+        )
         
         # Set new orientation
         if piece.type == TrackPieceType.CURVE:
             orientation = _next_orientation(orientation, piece.clockwise)
             pass
         
-        # Adding vismap entry if doing so will not cause two intersections to overlay
-        # This is done so that the vismap doesn't always have two intersections for every intersection that exists
-        working_cell = vismap[head[0]][head[1]]
-        position_tracker.append((head[0],head[1],len(working_cell)))
-        if not(piece.type == TrackPieceType.INTERSECTION 
+        working_cell = self.cells.setdefault((head_x,head_y),[])
+        self.positions.append((head_x,head_y,len(working_cell)))
+        if (piece.type == TrackPieceType.INTERSECTION 
         and len(working_cell) > 0
         and all([
             check.piece.type == TrackPieceType.INTERSECTION 
             for check in working_cell
         ])):
-            working_cell.append(Element(
-                piece,
-                orientation,
-                orientation_to_rotation(
-                    piece.type,
-                    orientation,
-                    previous_orientation
-                )
-            ))
-            pass
-        else:
             warn(
                 "Ignoring an intersection piece. If you have stacked two intersection pieces, this will cause bugs. If not, you can ignore this warning.",
-                stacklevel=2
+                stacklevel=_stacklevel
             )
-            working_cell.append(Element(
-                piece,
+            pass
+        working_cell.append(Element(
+            piece,
+            orientation,
+            orientation_to_rotation(
+                piece.type,
                 orientation,
-                orientation_to_rotation(
-                    piece.type,
-                    orientation,
-                    previous_orientation
-                )
-            ))
-        previous_orientation = orientation
+                self._previous_orientation
+            )
+        ))
+        self.pieces.append(piece)
+        self._orientation = orientation
+        self._previous_orientation = orientation
+        return head_x, head_y
+
+    def extend(self, pieces: list[TrackPiece], _stacklevel: int = 2):
+        for piece in pieces:
+            self.append(piece, _stacklevel+1)
+            pass
         pass
 
-    return vismap, position_tracker
+    def build(self) -> tuple[Vismap,PositionTracker]:
+        """Creates the vismap and position tracker of all pieces appended so far"""
+        # Coordinates are shifted so that the bounding box starts at (0,0)
+        min_x, min_y, _, _ = self.bounds
+        width, height = self.size
+        vismap: Vismap = [
+            [[] for _ in range(height)]
+            for _ in range(width)
+        ]
+        for (x,y), cell in self.cells.items():
+            vismap[x-min_x][y-min_y] = cell.copy()
+            pass
+        position_tracker = [
+            (x-min_x,y-min_y,z)
+            for x,y,z in self.positions
+        ]
+        return vismap, position_tracker
+    pass
+
+def generate(
+    track_map: list[TrackPiece],
+    orientation: tuple[int,int] = (1,0)
+) -> tuple[Vismap,PositionTracker]:
+    """Creates a 3d map of the track from the 1d version passed as an argument"""
+    builder = VismapBuilder(orientation)
+    builder.extend(track_map, 3)
+    return builder.build()
     pass
 
 ROTATION_FLIP_MAP = {
@@ -205,6 +199,14 @@ ROTATION_FLIP_MAP = {
 def h_rotation_flip(r: int) -> int: 
     return ROTATION_FLIP_MAP[r]
 
+def flip_element_h(e: Element) -> Element:
+    """The element as it looks on a horizontally flipped map"""
+    return Element(
+        e.piece,
+        (-e.orientation[0],e.orientation[1]),
+        h_rotation_flip(e.rotation)
+    )
+
 def flip_h(
     vismap: Vismap, 
     position_map: list[tuple[int,int,int]]
@@ -212,11 +214,7 @@ def flip_h(
     flipped_vismap = [
         [
             [
-                Element(
-                    e.piece,
-                    (-e.orientation[0],e.orientation[1]),
-                    h_rotation_flip(e.rotation)
-                )
+                flip_element_h(e)
                 for e in position
             ]
             for position in column
@@ -231,4 +229,195 @@ def flip_h(
     ]
     
     return flipped_vismap, flipped_positions
-    pass
\ No newline at end of file
+    pass
+
+
+PIECE_TYPES: tuple[TrackPieceType,...] = tuple(TrackPieceType)
+"""Piece type codes used by CompactVismap"""
+
+class CompactVismap:
+    """
+    A struct-of-arrays version of a vismap and its position tracker.
+
+    Every element is stored as one entry in each of the columns
+    `x`, `y`, `layer`, `piece_index` (the map position of the element),
+    `piece_type` (an index into `PIECE_TYPES`),
+    `orientation` (an index into `ORIENTATIONS`) and `rotation`.
+    `pieces` holds the TrackPiece of every element.
+
+    Elements are sorted by cell and layer.
+    The elements of cell (x,y) are the indexes in `cell(x,y)`,
+    which is backed by a CSR-style `cell_start` column.
+    `position_element` maps a map position to its element index.
+    """
+    ORIENTATIONS = _ORIENTATIONS
+
+    def __init__(self, width: int, height: int) -> None:
+        self.width = width
+        self.height = height
+        self.x = array("h")
+        self.y = array("h")
+        self.layer = array("h")
+        self.piece_index = array("i")
+        self.piece_type = array("b")
+        self.orientation = array("b")
+        self.rotation = array("h")
+        self.pieces: list[TrackPiece] = []
+        self.cell_start = array("i")
+        self.position_element = array("i")
+        pass
+
+    def __len__(self) -> int:
+        return len(self.pieces)
+
+    def cell(self, x: int, y: int) -> range:
+        """The element indexes of a cell, ordered by layer"""
+        index = x*self.height+y
+        return range(self.cell_start[index],self.cell_start[index+1])
+
+    def element(self, e: int) -> Element:
+        """Creates the Element for an element index"""
+        return Element(
+            self.pieces[e],
+            _ORIENTATIONS[self.orientation[e]],
+            self.rotation[e]
+        )
+
+    def _append(
+        self,
+        x: int,
+        y: int,
+        layer: int,
+        piece_index: int,
+        piece: TrackPiece,
+        orientation: int,
+        rotation: int
+    ):
+        self.x.append(x)
+        self.y.append(y)
+        self.layer.append(layer)
+        self.piece_index.append(piece_index)
+        self.piece_type.append(PIECE_TYPES.index(piece.type))
+        self.orientation.append(orientation)
+        self.rotation.append(rotation)
+        self.pieces.append(piece)
+        pass
+
+    def insert(
+        self,
+        x: int,
+        y: int,
+        piece_index: int,
+        element: Element
+    ) -> int:
+        """
+        Adds an element on top of cell (x,y) and returns its element index.
+        The size of the map doesn't change, the elements after it move up by one.
+        """
+        cell_index = x*self.height+y
+        e = self.cell_start[cell_index+1]
+        self.x.insert(e,x)
+        self.y.insert(e,y)
+        self.layer.insert(e,e-self.cell_start[cell_index])
+        self.piece_index.insert(e,piece_index)
+        self.piece_type.insert(e,PIECE_TYPES.index(element.piece.type))
+        self.orientation.insert(e,_ORIENTATIONS.index(element.orientation))
+        self.rotation.insert(e,element.rotation)
+        self.pieces.insert(e,element.piece)
+        for i in range(cell_index+1,len(self.cell_start)):
+            self.cell_start[i] += 1
+            pass
+        for position, moved in enumerate(self.position_element):
+            if moved >= e:
+                self.position_element[position] = moved+1
+                pass
+            pass
+        if piece_index >= 0:
+            missing = piece_index+1-len(self.position_element)
+            if missing > 0:
+                self.position_element.extend([-1]*missing)
+                pass
+            self.position_element[piece_index] = e
+            pass
+        return e
+
+    def _index_positions(self):
+        # Builds position_element from the piece_index column
+        self.position_element = array("i",[-1])*(max(self.piece_index,default=-1)+1)
+        for e, position in enumerate(self.piece_index):
+            if position >= 0:
+                self.position_element[position] = e
+                pass
+            pass
+        pass
+
+    @classmethod
+    def from_nested(
+        cls,
+        vismap: Vismap,
+        position_tracker: PositionTracker|None = None
+    ) -> "CompactVismap":
+        """
+        Converts a nested vismap into its compact form.
+        Without a position tracker, all piece indexes are -1.
+        """
+        compact = cls(len(vismap),len(vismap[0]))
+        positions: dict[tuple[int,int,int],int] = {
+            location: position
+            for position, location in enumerate(position_tracker or ())
+        }
+        for x, column in enumerate(vismap):
+            for y, cell in enumerate(column):
+                compact.cell_start.append(len(compact))
+                for layer, e in enumerate(cell):
+                    compact._append(
+                        x, y, layer,
+                        positions.get((x,y,layer),-1),
+                        e.piece,
+                        _ORIENTATIONS.index(e.orientation),
+                        e.rotation
+                    )
+                    pass
+                pass
+            pass
+        compact.cell_start.append(len(compact))
+        compact._index_positions()
+        return compact
+
+    def to_nested(self) -> tuple[Vismap,PositionTracker]:
+        """Converts back into a nested vismap and its position tracker"""
+        vismap: Vismap = [
+            [
+                [self.element(e) for e in self.cell(x,y)]
+                for y in range(self.height)
+            ]
+            for x in range(self.width)
+        ]
+        position_tracker = [
+            (self.x[e],self.y[e],self.layer[e])
+            for e in self.position_element
+        ]
+        return vismap, position_tracker
+
+    def flip_h(self) -> "CompactVismap":
+        """The compact equivalent of `flip_h`"""
+        flipped = type(self)(self.width,self.height)
+        for x in range(self.width):
+            for y in range(self.height):
+                flipped.cell_start.append(len(flipped))
+                for e in self.cell(self.width-1-x,y):
+                    o = _ORIENTATIONS[self.orientation[e]]
+                    flipped._append(
+                        x, y, self.layer[e],
+                        self.piece_index[e],
+                        self.pieces[e],
+                        _ORIENTATIONS.index((-o[0],o[1])),
+                        h_rotation_flip(self.rotation[e])
+                    )
+                    pass
+                pass
+            pass
+        flipped.cell_start.append(len(flipped))
+        flipped._index_positions()
+        return flipped
+    pass
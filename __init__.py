@@ -1 +1 @@
-from .UiMain import Ui
\ No newline at end of file
+from .UiMain import Ui, createUi
\ No newline at end of file